@@ -0,0 +1 @@
+'''Offline benchmarks of InstaBot running against a local Instagram stub.'''
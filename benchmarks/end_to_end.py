@@ -0,0 +1,221 @@
+'''benchmarks.end_to_end: runs InstaBot services against the local Instagram
+stub and reports their throughput.
+
+Usage:
+  end_to_end.py [options]
+  end_to_end.py -h | --help
+
+Options:
+  --duration=SECONDS   How long services should run [default: 60].
+  --followers=COUNT    Followers of every stub user [default: 200].
+  --users=COUNT        Size of the universe of stub users [default: 100000].
+  --fixture=COUNT      Users to insert in DB before start [default: 0].
+  --sqlite=PATH        SQLite DB file [default: :memory:].
+  --mysql=CONFIG       Use MySQL DB from the `db` section of given
+                       configuration.yml instead of SQLite. The DB should be
+                       empty.
+
+Run it as `python -m benchmarks.end_to_end` from the repository root.
+'''
+
+import asyncio
+import datetime
+import logging
+import resource
+import tempfile
+import time
+import yaml
+from .stub_server import InstagramStub
+from docopt import docopt
+from instabot import db, instagram, user
+from instabot.archive_service import ArchiveService
+from instabot.archived_user import ArchivedUser
+from instabot.candidate_counters import CandidateCounters
+from instabot.configuration import Configuration
+from instabot.followers_cursor import FollowersCursor
+from instabot.following_service import FollowingService
+from instabot.known_users import KnownUsers
+from instabot.like_service import LikeService
+from instabot.media_service import MediaService
+from instabot.scheduler import Scheduler
+from instabot.stats_service import StatsService
+from instabot.user import User
+from instabot.user_service import UserService
+from peewee import SqliteDatabase
+
+FIXTURE_BATCH_SIZE = 500
+LOGGER = logging.getLogger('benchmarks.end_to_end')
+
+
+class QueryCountingMixin:
+    """Counts SQL statements executed by the database."""
+
+    queries_count = 0
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        self.queries_count += 1
+        return super().execute_sql(sql, params, require_commit)
+
+
+class QueryCountingSqliteDatabase(QueryCountingMixin, SqliteDatabase):
+    pass
+
+
+class QueryCountingMySQLDatabase(
+        QueryCountingMixin,
+        db.RetryingMySQLDatabase,
+        ):
+    pass
+
+
+def create_configuration(db_configuration):
+    """Creates configuration making Client sleep as little as possible."""
+    return load_configuration({
+        'credentials': {'username': 'benchmark', 'password': 'benchmark'},
+        'db': db_configuration,
+        'following_hours': 0,
+        'hashtags': ['python', 'asyncio', 'benchmark'],
+        'instagram': {
+            'limit_sleep_time_coefficient': 0,
+            'limit_sleep_time_min': 0,
+            'success_sleep_time_coefficient': 0,
+            'success_sleep_time_max': 0,
+            'success_sleep_time_min': 0,
+            },
+        'logging': {'version': 1},
+        'users_to_follow_cache_size': 300,
+        })
+
+
+def load_configuration(configuration):
+    """Loads `Configuration` from the dict."""
+    with tempfile.NamedTemporaryFile('w', suffix='.yml') as f:
+        yaml.safe_dump(configuration, f)
+        f.flush()
+        return Configuration(f.name)
+
+
+def create_db(arguments):
+    if arguments['--mysql'] is None:
+        # Services use the DB from a separate thread, so the connection is
+        # shared for in-memory DB to be the same for all threads.
+        database = QueryCountingSqliteDatabase(
+            arguments['--sqlite'],
+            threadlocals=False,
+            check_same_thread=False,
+            )
+        db_configuration = {
+            'host': None,
+            'name': arguments['--sqlite'],
+            'user': None,
+            'password': None,
+            }
+    else:
+        with open(arguments['--mysql']) as f:
+            db_configuration = yaml.safe_load(f)['db']
+        database = QueryCountingMySQLDatabase(
+            db_configuration['name'],
+            host=db_configuration['host'],
+            user=db_configuration['user'],
+            password=db_configuration['password'],
+            )
+    user.database_proxy.initialize(database)
+    database.create_tables([User, FollowersCursor, ArchivedUser], safe=True)
+    return database, db_configuration
+
+
+def insert_fixture(count, following_hours):
+    was_followed_at = datetime.datetime.utcnow() - \
+        datetime.timedelta(hours=following_hours)
+    for start in range(0, count, FIXTURE_BATCH_SIZE):
+        rows = [
+            {
+                'following_depth': 1,
+                'instagram_id': 10 ** 12 + i,
+                'state': User.FINISHED,
+                'username': 'fixture{}'.format(i),
+                # Make them look like they were unfollowed long time ago.
+                'was_followed_at': was_followed_at,
+                }
+            for i in range(start, min(start + FIXTURE_BATCH_SIZE, count))
+            ]
+        User.insert_many(rows).execute()
+
+
+def main():
+    arguments = docopt(__doc__)
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+
+    stub = InstagramStub(
+        followers_count=int(arguments['--followers']),
+        users_count=int(arguments['--users']),
+        )
+    instagram.BASE_URL = loop.run_until_complete(stub.start(loop))
+
+    database, db_configuration = create_db(arguments)
+    configuration = create_configuration(db_configuration)
+    insert_fixture(int(arguments['--fixture']), configuration.following_hours)
+
+    StatsService()
+    scheduler = Scheduler(configuration)
+    known_users = KnownUsers()
+    following_client = instagram.Client(configuration)
+    User.create(
+        following_depth=0,
+        instagram_id=following_client.id,
+        username=configuration.instagram_username,
+        state=User.FINISHED,
+        was_followed_at=datetime.datetime.utcnow(),
+        )
+    known_users.warm_up()
+    candidate_counters = CandidateCounters()
+    candidate_counters.reconcile()
+    like_client = instagram.Client(configuration)
+    media_service = MediaService(like_client, configuration)
+    services = [
+        scheduler,
+        candidate_counters,
+        ArchiveService(following_client),
+        UserService(following_client, configuration),
+        FollowingService(following_client, configuration),
+        media_service,
+        LikeService(like_client, media_service),
+        ]
+
+    stub.counts.clear()
+    database.queries_count = 0
+    started = time.perf_counter()
+    tasks = [loop.create_task(service.run()) for service in services]
+    loop.run_until_complete(asyncio.sleep(int(arguments['--duration'])))
+    elapsed = time.perf_counter() - started
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.run_until_complete(stub.stop())
+
+    actions_count = stub.counts['follow'] + stub.counts['unfollow'] + \
+        stub.counts['like']
+    requests_count = sum(stub.counts.values())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('Elapsed: {:.1f} s'.format(elapsed))
+    print('Requests by endpoint: {}'.format(dict(stub.counts)))
+    print('Actions: {} ({:.2f}/s)'.format(
+        actions_count,
+        actions_count / elapsed,
+        ))
+    print('Requests: {} ({:.2f}/s)'.format(
+        requests_count,
+        requests_count / elapsed,
+        ))
+    print('DB queries: {} ({:.2f} per action, {:.2f} per request)'.format(
+        database.queries_count,
+        database.queries_count / max(actions_count, 1),
+        database.queries_count / max(requests_count, 1),
+        ))
+    print('Users in DB: {}'.format(User.select().count()))
+    print('Peak RSS: {:.1f} MiB'.format(peak_rss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''benchmarks.hashtag_page: compares extraction of media IDs from
+`explore/tags/` pages by `HashtagPageParser` with decoding the whole page.
+
+Usage:
+  hashtag_page.py [options] [PAGE...]
+  hashtag_page.py -h | --help
+
+Arguments:
+  PAGE  Recorded `explore/tags/` HTML page. A synthetic page is used if no
+        pages were specified.
+
+Options:
+  --repeat=COUNT      How many times to parse every page [default: 200].
+  --chunk-size=BYTES  Size of chunks to feed the parser with [default: 16384].
+
+Run it as `python -m benchmarks.hashtag_page` from the repository root.
+'''
+
+import json
+import re
+import time
+import tracemalloc
+from .stub_server import render_hashtag_page
+from docopt import docopt
+from instabot.hashtag_page import HashtagPageParser
+
+
+def extract_whole(page):
+    """Extracts media IDs the way `Client` did before streaming parser."""
+    text = page.decode('utf-8', errors='ignore')
+    match = re.search(
+        r'<script type="text/javascript">[\w\.]+\s*=\s*(\{[^<]+);</script>',
+        text,
+        )
+    data = json.loads(match.group(1))
+    tag = data['entry_data']['TagPage'][0]['graphql']['hashtag']
+    return [edge['node']['id'] for edge in tag['edge_hashtag_to_media']['edges']]
+
+
+def extract_streaming(page, chunk_size):
+    parser = HashtagPageParser()
+    for i in range(0, len(page), chunk_size):
+        if parser.feed(page[i:i + chunk_size]):
+            break
+    return parser.get_media()
+
+
+def measure(name, func, pages, repeat):
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            func(page)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<10} {:8.3f} ms/page {:8.1f} KiB peak'.format(
+        name,
+        elapsed * 1000 / repeat / len(pages),
+        peak / 1024,
+        ))
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments['PAGE']:
+        pages = []
+        for filename in arguments['PAGE']:
+            with open(filename, 'rb') as f:
+                pages.append(f.read())
+    else:
+        pages = [render_hashtag_page('python').encode('utf-8')]
+    chunk_size = int(arguments['--chunk-size'])
+    repeat = int(arguments['--repeat'])
+    for page in pages:
+        if extract_whole(page) != extract_streaming(page, chunk_size):
+            raise SystemExit('Parsers disagree')
+    print('{} pages, {:.1f} KiB on average'.format(
+        len(pages),
+        sum(len(page) for page in pages) / len(pages) / 1024,
+        ))
+    measure('whole', extract_whole, pages, repeat)
+    measure(
+        'streaming',
+        lambda page: extract_streaming(page, chunk_size),
+        pages,
+        repeat,
+        )
+
+
+if __name__ == '__main__':
+    main()
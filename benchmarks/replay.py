@@ -0,0 +1,83 @@
+'''benchmarks.replay: measures how fast `instagram.Client` handles responses
+recorded to a cassette.
+
+Record a cassette by running the bot with `instagram.cassette` option set and
+without `instagram.session_file`, so the login is recorded too.
+
+Usage:
+  replay.py [options] CASSETTE
+  replay.py -h | --help
+
+Options:
+  --repeat=COUNT  How many times to call every method [default: 1000].
+
+Run it as `python -m benchmarks.replay` from the repository root.
+'''
+
+import asyncio
+import functools
+import time
+from .end_to_end import create_configuration
+from docopt import docopt
+from instabot import instagram
+from instabot.cassette import ReplaySession
+from instabot.clock import Clock
+from instabot.user import User
+
+DB_CONFIGURATION = {
+    'host': None,
+    'name': ':memory:',
+    'user': None,
+    'password': None,
+    }
+
+
+class NoSleepClock(Clock):
+    async def sleep(self, delay):
+        pass
+
+
+async def measure(name, func, repeat):
+    started = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            await func()
+    except KeyError as e:
+        print('{:<22} skipped: {}'.format(name, e))
+        return
+    elapsed = time.perf_counter() - started
+    print('{:<22} {:8.3f} ms/call'.format(name, elapsed * 1000 / repeat))
+
+
+def main():
+    arguments = docopt(__doc__)
+    loop = asyncio.get_event_loop()
+    client = instagram.Client(
+        create_configuration(DB_CONFIGURATION),
+        clock=NoSleepClock(),
+        session_factory=functools.partial(
+            ReplaySession,
+            arguments['CASSETTE'],
+            ),
+        )
+    user = User(instagram_id=1, username='replay')
+    repeat = int(arguments['--repeat'])
+    loop.run_until_complete(measure(
+        '_get_followers_page',
+        functools.partial(client._get_followers_page, user),
+        repeat,
+        ))
+    loop.run_until_complete(measure(
+        '_get_followed_page',
+        functools.partial(client._get_followed_page, user),
+        repeat,
+        ))
+    loop.run_until_complete(measure(
+        'get_media_by_hashtag',
+        functools.partial(client.get_media_by_hashtag, 'replay'),
+        repeat,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''benchmarks.simulate: replays days of InstaBot work in virtual time against
+the local Instagram stub to see which rates a configuration produces.
+
+Usage:
+  simulate.py [options]
+  simulate.py -h | --help
+
+Options:
+  --configuration=PATH    configuration.yml to take `following_hours`,
+                          `hashtags`, `instagram` and
+                          `users_to_follow_cache_size` from. Values from
+                          README example are used by default.
+  --days=DAYS             Virtual days to simulate [default: 7].
+  --actions-per-hour=N    Actions allowed by the stub per hour. Unlimited by
+                          default.
+  --followers=COUNT       Followers of every stub user [default: 200].
+  --users=COUNT           Size of the universe of stub users
+                          [default: 1000000].
+  --sqlite=PATH           SQLite DB file [default: :memory:].
+  --mysql=CONFIG          Use MySQL DB from the `db` section of given
+                          configuration.yml instead of SQLite. The DB should
+                          be empty.
+
+Run it as `python -m benchmarks.simulate` from the repository root.
+'''
+
+import asyncio
+import collections
+import logging
+import sys
+import time
+import yaml
+from .end_to_end import create_db, load_configuration
+from .stub_server import InstagramStub
+from docopt import docopt
+from instabot import instagram
+from instabot.archive_service import ArchiveService
+from instabot.budget import Budget
+from instabot.candidate_counters import CandidateCounters
+from instabot.clock import VirtualClock
+from instabot.db import run_in_db
+from instabot.errors import ConfigurationError
+from instabot.following_service import FollowingService
+from instabot.known_users import KnownUsers
+from instabot.like_service import LikeService
+from instabot.media_service import MediaService
+from instabot.scheduler import Scheduler
+from instabot.stats_service import StatsService
+from instabot.user import User
+from instabot.user_service import UserService
+
+DEFAULT_CONFIGURATION = {
+    'following_hours': 120,
+    'hashtags': ['I', 'люблю', 'Python'],
+    'instagram': {
+        'limit_sleep_time_coefficient': 1.3,
+        'limit_sleep_time_min': 30,
+        'success_sleep_time_coefficient': 0.5,
+        'success_sleep_time_max': 6,
+        'success_sleep_time_min': 4,
+        },
+    'users_to_follow_cache_size': 300,
+    }
+LOGGER = logging.getLogger('benchmarks.simulate')
+SAMPLE_INTERVAL = 60 * 60
+
+
+async def sample(clock, stub, media_service, samples):
+    """Saves stub counters and queue sizes every virtual hour."""
+    while True:
+        await clock.sleep(SAMPLE_INTERVAL)
+        samples.append({
+            'counts': collections.Counter(stub.counts),
+            'to_follow': await run_in_db(
+                User.select().where(User.state == User.CANDIDATE).count,
+                ),
+            'followed': await run_in_db(
+                User.select().where(User.state == User.FOLLOWED).count,
+                ),
+            'media': len(media_service),
+            })
+
+
+def report(samples):
+    actions = ('follow', 'unfollow', 'like', 'blocked')
+    print('{:>5} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8} {:>6}'.format(
+        'Day', 'Follows', 'Unfollow', 'Likes', 'Blocked', 'To follow',
+        'Followed', 'Media',
+        ))
+    previous = collections.Counter()
+    for day, i in enumerate(range(23, len(samples), 24), 1):
+        counts = samples[i]['counts']
+        print('{:>5} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8} {:>6}'.format(
+            day,
+            *[counts[action] - previous[action] for action in actions],
+            samples[i]['to_follow'],
+            samples[i]['followed'],
+            samples[i]['media'],
+            ))
+        previous = counts
+    if samples:
+        hours = len(samples)
+        counts = samples[-1]['counts']
+        print('Sustained rates per hour: {}'.format(', '.join(
+            '{} {:.1f}'.format(action, counts[action] / hours)
+            for action in actions
+            )))
+
+
+def main():
+    arguments = docopt(__doc__)
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    clock = VirtualClock()
+
+    actions_per_hour = arguments['--actions-per-hour']
+    stub = InstagramStub(
+        followers_count=int(arguments['--followers']),
+        users_count=int(arguments['--users']),
+        actions_per_hour=None if actions_per_hour is None
+        else int(actions_per_hour),
+        clock=clock,
+        )
+    instagram.BASE_URL = loop.run_until_complete(stub.start(loop))
+
+    database, db_configuration = create_db(arguments)
+    configuration = dict(DEFAULT_CONFIGURATION)
+    if arguments['--configuration'] is not None:
+        with open(arguments['--configuration']) as f:
+            configuration.update(yaml.safe_load(f))
+    configuration.update({
+        'credentials': {'username': 'simulation', 'password': 'simulation'},
+        'db': db_configuration,
+        'logging': {'version': 1},
+        })
+    configuration = load_configuration(configuration)
+
+    stats_service = StatsService(clock)
+    known_users = KnownUsers()
+    if configuration.instagram_actions_per_hour:
+        try:
+            budget = Budget(configuration, clock)
+        except ConfigurationError as e:
+            sys.exit('Can\'t set up budget: {}'.format(e))
+    else:
+        budget = None
+    scheduler = Scheduler(configuration, clock, budget=budget)
+    following_client = instagram.Client(configuration, clock, budget=budget)
+    User.create(
+        following_depth=0,
+        instagram_id=following_client.id,
+        username=configuration.instagram_username,
+        state=User.FINISHED,
+        was_followed_at=clock.now(),
+        )
+    known_users.warm_up()
+    candidate_counters = CandidateCounters(clock)
+    candidate_counters.reconcile()
+    like_client = instagram.Client(configuration, clock, budget=budget)
+    media_service = MediaService(like_client, configuration, clock)
+    samples = []
+    coroutines = [
+        stats_service.run(),
+        scheduler.run(),
+        candidate_counters.run(),
+        ArchiveService(following_client, clock).run(),
+        UserService(following_client, configuration, clock).run(),
+        FollowingService(following_client, configuration, clock).run(),
+        media_service.run(),
+        LikeService(like_client, media_service, clock).run(),
+        sample(clock, stub, media_service, samples),
+        ]
+
+    started = time.perf_counter()
+    tasks = [loop.create_task(coroutine) for coroutine in coroutines]
+    loop.run_until_complete(clock.run(float(arguments['--days']) * 24 * 3600))
+    elapsed = time.perf_counter() - started
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.run_until_complete(stub.stop())
+
+    report(samples)
+    print('Simulated {} days in {:.1f} s, {} DB queries'.format(
+        arguments['--days'],
+        elapsed,
+        database.queries_count,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+'''benchmarks.stub_server: local stub of Instagram endpoints used by
+`instagram.Client`.'''
+
+import collections
+import json
+import random
+import re
+from aiohttp import web
+from instabot.clock import Clock
+
+HASHTAG_MEDIA_COUNT = 70
+LOGGED_IN_USER_ID = '1'
+QUERY_CURSOR_RE = re.compile(
+    r'(?P<edge>followed_by|follows)\.'
+    r'(?:first\((?P<first>\d+)\)|after\((?P<after>\d+),\s*(?P<count>\d+)\))',
+    )
+QUERY_USER_RE = re.compile(r'ig_user\((?P<id>\d+)\)')
+
+
+class InstagramStub:
+    """Serves synthetic but realistically shaped Instagram responses.
+
+    Followers of every user are drawn from a universe of `users_count`
+    users, so crawling several users yields duplicates like the real site
+    does.
+
+    Args:
+        followers_count (int): Number of followers of every user.
+        users_count (int): Size of the universe of users.
+        seed (int): Seed for generating deterministic data.
+        actions_per_hour (int, optional): How many follows, unfollows and
+            likes are allowed during an hour. Exceeding actions are blocked
+            like Instagram does. Unlimited by default.
+        clock (Clock, optional): Clock to measure hours with.
+
+    """
+
+    def __init__(self, followers_count=200, users_count=100000, seed=0,
+                 actions_per_hour=None, clock=None):
+        self._actions_per_hour = actions_per_hour
+        self._actions_hour = None
+        self._actions_hour_count = 0
+        self._clock = Clock() if clock is None else clock
+        self._followers_count = followers_count
+        self._users_count = users_count
+        self._seed = seed
+        self._followed = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self._server = None
+        self._handler = None
+
+    def _create_app(self, loop):
+        app = web.Application(loop=loop)
+        app.router.add_route('GET', '/', self._index)
+        app.router.add_route(
+            'POST',
+            '/accounts/login/ajax/',
+            self._login,
+            )
+        app.router.add_route('POST', '/query/', self._query)
+        app.router.add_route(
+            'POST',
+            '/web/friendships/{id}/follow/',
+            self._follow,
+            )
+        app.router.add_route(
+            'POST',
+            '/web/friendships/{id}/unfollow/',
+            self._unfollow,
+            )
+        app.router.add_route('POST', '/web/likes/{id}/like/', self._like)
+        app.router.add_route('GET', '/explore/tags/{tag}/', self._hashtag)
+        return app
+
+    async def start(self, loop, host='127.0.0.1', port=0):
+        """Starts serving.
+
+        Returns:
+            str: Base URL of the stub with trailing slash.
+
+        """
+        self._handler = self._create_app(loop).make_handler()
+        self._server = await loop.create_server(self._handler, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    async def stop(self):
+        await self._handler.finish_connections(1)
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _ajax_response(self, data=None):
+        response_dict = {'status': 'ok'}
+        if data is not None:
+            response_dict.update(data)
+        return web.Response(
+            body=json.dumps(response_dict).encode('utf-8'),
+            content_type='application/json',
+            )
+
+    def _blocked_response(self):
+        """Counts the action.
+
+        Returns:
+            web.Response: Response about blocked action if the action exceeds
+            `actions_per_hour` or `None`.
+
+        """
+        if self._actions_per_hour is None:
+            return None
+        hour = self._clock.now().replace(minute=0, second=0, microsecond=0)
+        if hour != self._actions_hour:
+            self._actions_hour = hour
+            self._actions_hour_count = 0
+        self._actions_hour_count += 1
+        if self._actions_hour_count <= self._actions_per_hour:
+            return None
+        self.counts['blocked'] += 1
+        return web.Response(
+            body=json.dumps({
+                'status': 'fail',
+                'message': 'Please wait a few minutes before you try again. '
+                'You are temporarily blocked.',
+                }).encode('utf-8'),
+            status=400,
+            content_type='application/json',
+            )
+
+    def _generate_user(self, rnd):
+        user_id = rnd.randrange(2, self._users_count + 2)
+        return {
+            'id': str(user_id),
+            'is_verified': rnd.random() < 0.01,
+            'followed_by': {'count': rnd.randrange(10000)},
+            'follows': {'count': rnd.randrange(2000)},
+            'followed_by_viewer': str(user_id) in self._followed,
+            'follows_viewer': rnd.random() < 0.05,
+            'requested_by_viewer': False,
+            'full_name': 'User {}'.format(user_id),
+            'profile_pic_url':
+                'https://scontent.cdninstagram.com/{}.jpg'.format(user_id),
+            'username': 'user{}'.format(user_id),
+            }
+
+    async def _follow(self, request):
+        response = self._blocked_response()
+        if response is not None:
+            return response
+        self.counts['follow'] += 1
+        user_id = request.match_info['id']
+        self._followed[user_id] = 'user{}'.format(user_id)
+        return self._ajax_response({'result': 'following'})
+
+    async def _hashtag(self, request):
+        self.counts['hashtag'] += 1
+        text = render_hashtag_page(
+            request.match_info['tag'],
+            '{}:{}'.format(self._seed, self.counts['hashtag']),
+            self._users_count,
+            )
+        return web.Response(
+            body=text.encode('utf-8'),
+            content_type='text/html',
+            )
+
+    async def _index(self, request):
+        self.counts['index'] += 1
+        response = web.Response(
+            body=b'<!DOCTYPE html><html></html>',
+            content_type='text/html',
+            )
+        response.set_cookie('csrftoken', 'stubcsrftoken')
+        return response
+
+    async def _like(self, request):
+        response = self._blocked_response()
+        if response is not None:
+            return response
+        self.counts['like'] += 1
+        return self._ajax_response()
+
+    async def _login(self, request):
+        self.counts['login'] += 1
+        response = self._ajax_response({
+            'authenticated': True,
+            'user': True,
+            })
+        response.set_cookie('csrftoken', 'stubcsrftoken')
+        response.set_cookie('ds_user_id', LOGGED_IN_USER_ID)
+        return response
+
+    async def _query(self, request):
+        self.counts['query'] += 1
+        data = await request.post()
+        query = data.get('q', '')
+        user_match = QUERY_USER_RE.search(query)
+        cursor_match = QUERY_CURSOR_RE.search(query)
+        if user_match is None:
+            return self._ajax_response()
+        user_id = user_match.group('id')
+        if cursor_match is None:
+            return self._ajax_response({'id': user_id})
+        if cursor_match.group('first') is not None:
+            offset = 0
+            count = int(cursor_match.group('first'))
+        else:
+            offset = int(cursor_match.group('after'))
+            count = int(cursor_match.group('count'))
+        if cursor_match.group('edge') == 'follows':
+            nodes, total = self._followed_nodes(offset, count)
+        else:
+            nodes, total = self._followers_nodes(user_id, offset, count)
+        end = offset + len(nodes)
+        return self._ajax_response({
+            cursor_match.group('edge'): {
+                'count': total,
+                'page_info': {
+                    'end_cursor': str(end) if nodes else None,
+                    'has_next_page': end < total,
+                    },
+                'nodes': nodes,
+                },
+            })
+
+    def _followed_nodes(self, offset, count):
+        ids = list(self._followed)[offset:offset + count]
+        nodes = [
+            {'id': user_id, 'username': self._followed[user_id]}
+            for user_id in ids
+            ]
+        return nodes, len(self._followed)
+
+    def _followers_nodes(self, user_id, offset, count):
+        count = max(0, min(count, self._followers_count - offset))
+        nodes = [
+            self._generate_user(random.Random('{}:{}:{}'.format(
+                self._seed,
+                user_id,
+                offset + i,
+                )))
+            for i in range(count)
+            ]
+        return nodes, self._followers_count
+
+    async def _unfollow(self, request):
+        response = self._blocked_response()
+        if response is not None:
+            return response
+        self.counts['unfollow'] += 1
+        self._followed.pop(request.match_info['id'], None)
+        return self._ajax_response({'result': ''})
+
+
+def render_hashtag_page(tag, seed=0, users_count=100000):
+    """Renders `explore/tags/` page shaped like the real one.
+
+    Returns:
+        str: HTML page.
+
+    """
+    rnd = random.Random('{}:{}'.format(seed, tag))
+    edges = [
+        {
+            'node': {
+                'id': str(rnd.randrange(10 ** 18, 10 ** 19)),
+                'shortcode': 'B{:010d}'.format(rnd.randrange(10 ** 10)),
+                'display_url': 'https://scontent.cdninstagram.com/p.jpg',
+                'edge_media_to_caption': {
+                    'edges': [{'node': {'text': '#{} '.format(tag) * 20}}],
+                    },
+                'edge_liked_by': {'count': rnd.randrange(1000)},
+                'owner': {'id': str(rnd.randrange(users_count))},
+                },
+            }
+        for _ in range(HASHTAG_MEDIA_COUNT)
+        ]
+    shared_data = {
+        'config': {'csrf_token': 'stubcsrftoken', 'viewer': None},
+        'entry_data': {
+            'TagPage': [{
+                'graphql': {
+                    'hashtag': {
+                        'name': tag,
+                        'edge_hashtag_to_media': {
+                            'count': 1000000,
+                            'edges': edges,
+                            },
+                        'edge_hashtag_to_top_posts': {
+                            'edges': edges[:9],
+                            },
+                        },
+                    },
+                }],
+            },
+        }
+    return (
+        '<!DOCTYPE html><html><head><title>#{tag}</title>'
+        '<script type="text/javascript">window.__bootstrap = 1;</script>'
+        '</head><body>{padding}'
+        '<script type="text/javascript">window._sharedData = {data};'
+        '</script></body></html>'
+        ).format(
+            tag=tag,
+            padding='<div class="stub"></div>' * 2000,
+            data=json.dumps(shared_data),
+            )
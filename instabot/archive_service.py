@@ -0,0 +1,89 @@
+import logging
+import peewee
+from .archived_user import ArchivedUser
+from .clock import Clock
+from .db import run_in_db
+from .user import User
+
+ARCHIVING_INTERVAL = 60 * 60
+BATCH_SIZE = 1000
+LOGGER = logging.getLogger('instabot.archive_service')
+
+
+class ArchiveService:
+    """Moves finished users from `User` table to `ArchivedUser` table.
+
+    Finished users are the ones which were unfollowed (or can't be
+    followed). They're needed only to not follow them again, so the narrow
+    archive table is enough for them and the live table keeps only
+    candidates and followed users. The exception is finished users at the
+    following depth being crawled whose followers weren't fetched yet, they
+    stay as the crawl frontier. Deeper levels are crawled through candidates
+    and followed users. The client's own user is never archived, its row
+    marks InstaBot as installed.
+
+    """
+
+    def __init__(self, client, clock=None):
+        self._clock = Clock() if clock is None else clock
+        self._own_instagram_id = client.id
+
+    async def run(self):
+        while True:
+            try:
+                archived_count = 0
+                while True:
+                    batch_count = await run_in_db(self._archive_batch)
+                    if batch_count == 0:
+                        break
+                    archived_count += batch_count
+                LOGGER.debug('%d users were archived', archived_count)
+            except peewee.PeeweeException as e:
+                LOGGER.warning('Can\'t archive users: %s', e)
+            await self._clock.sleep(ARCHIVING_INTERVAL)
+
+    def _archive_batch(self):
+        """Moves next batch of finished users to the archive.
+
+        Returns:
+            int: Number of archived users.
+
+        """
+        condition = (User.state == User.FINISHED) & \
+            (User.instagram_id != self._own_instagram_id)
+        crawled_depth = User \
+            .select(peewee.fn.MIN(User.following_depth)) \
+            .where(User.were_followers_fetched == False) \
+            .scalar()
+        if crawled_depth is not None:
+            condition &= (User.were_followers_fetched == True) | \
+                (User.following_depth != crawled_depth)
+        users = list(
+            User
+            .select(User.id, User.instagram_id)
+            .where(condition)
+            .limit(BATCH_SIZE)
+            .tuples()
+            )
+        if not users:
+            return 0
+        instagram_ids = [instagram_id for _, instagram_id in users]
+        with User._meta.database.atomic():
+            archived_ids = {
+                instagram_id for (instagram_id,) in ArchivedUser
+                .select(ArchivedUser.instagram_id)
+                .where(ArchivedUser.instagram_id << instagram_ids)
+                .tuples()
+                }
+            rows = [
+                {'instagram_id': instagram_id}
+                for instagram_id in instagram_ids
+                if instagram_id not in archived_ids
+                ]
+            if rows:
+                ArchivedUser.insert_many(rows).execute()
+            User \
+                .delete() \
+                .where(User.id << [user_id for user_id, _ in users]) \
+                .execute()
+        return len(users)
@@ -0,0 +1,14 @@
+from .user import database_proxy
+from peewee import *
+
+
+class ArchivedUser(Model):
+    """User who was unfollowed or can't be followed.
+
+    Only Instagram ID is kept to not follow the user again.
+
+    """
+    instagram_id = BigIntegerField(primary_key=True)
+
+    class Meta:
+        database = database_proxy
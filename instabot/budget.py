@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import logging
+from .clock import Clock
+from .errors import ConfigurationError
+from .metrics import REGISTRY
+
+ACTIONS = ('follow', 'like', 'query', 'unfollow')
+LOGGER = logging.getLogger('instabot.budget')
+TOKENS = REGISTRY.gauge(
+    'instabot_budget_tokens',
+    'Actions which may be issued immediately by action type.',
+    )
+WAIT_DURATION = REGISTRY.counter(
+    'instabot_budget_wait_seconds_total',
+    'Time spent waiting for the budget by action type.',
+    )
+
+
+class TokenBucket:
+    """Allows `rate` actions per second with bursts up to `capacity`.
+
+    Waiters are served in FIFO order.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum number of tokens.
+        clock (Clock)
+
+    """
+
+    def __init__(self, rate, capacity, clock):
+        self._rate = rate
+        self._capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock.now()
+        self._lock = asyncio.Lock()
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    async def acquire(self):
+        """Waits until a token is available and takes it.
+
+        Returns:
+            float: Seconds spent waiting.
+
+        """
+        waited = 0
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                delay = (1 - self._tokens) / self._rate
+                await self._clock.sleep(delay)
+                waited += delay
+                self._refill()
+            self._tokens -= 1
+        return waited
+
+    def _refill(self):
+        now = self._clock.now()
+        elapsed = (now - self._updated).total_seconds()
+        self._updated = now
+        self._tokens = min(
+            self._capacity,
+            self._tokens + elapsed * self._rate,
+            )
+
+
+class Budget:
+    """Per action type budgets shared by all clients.
+
+    Args:
+        configuration (Configuration)
+        clock (Clock, optional)
+
+    Raises:
+        ConfigurationError: If actions rates weren't specified or are
+            invalid.
+
+    """
+
+    def __init__(self, configuration, clock=None):
+        actions_per_hour = configuration.instagram_actions_per_hour
+        if not actions_per_hour:
+            raise ConfigurationError('Actions per hour weren\'t specified')
+        unknown_actions = set(actions_per_hour) - set(ACTIONS)
+        if unknown_actions:
+            raise ConfigurationError('Unknown actions: {}'.format(
+                ', '.join(sorted(unknown_actions)),
+                ))
+        if any(per_hour <= 0 for per_hour in actions_per_hour.values()):
+            raise ConfigurationError('Actions per hour should be positive')
+        # Bucket which can't hold a whole token would never let actions go.
+        if configuration.instagram_actions_burst < 1:
+            raise ConfigurationError('Actions burst should be at least 1')
+        clock = Clock() if clock is None else clock
+        # Action -> number of budgets taken in advance by `reserve`.
+        self._reserved = collections.Counter()
+        self._buckets = {
+            action: TokenBucket(
+                per_hour / 60 / 60,
+                configuration.instagram_actions_burst,
+                clock,
+                )
+            for action, per_hour in actions_per_hour.items()
+            }
+        REGISTRY.add_collector(self._collect_stats)
+
+    async def acquire(self, action):
+        """Waits until the action may be issued.
+
+        Actions without specified rate aren't limited.
+
+        Args:
+            action (str): One of `ACTIONS`.
+
+        """
+        if self._reserved[action] > 0:
+            self._reserved[action] -= 1
+            return
+        await self._take(action)
+
+    async def reserve(self, action):
+        """Waits until the action may be issued and takes its budget in
+        advance, so the next `acquire` of the action returns immediately.
+
+        Args:
+            action (str): One of `ACTIONS`.
+
+        """
+        if await self._take(action):
+            self._reserved[action] += 1
+
+    def _collect_stats(self):
+        for action, bucket in self._buckets.items():
+            TOKENS.set(bucket.tokens, action=action)
+
+    async def _take(self, action):
+        """
+        Returns:
+            bool: Whether the action is limited.
+
+        """
+        try:
+            bucket = self._buckets[action]
+        except KeyError:
+            return False
+        waited = await bucket.acquire()
+        if waited:
+            LOGGER.debug('Waited %.1f sec for %s budget', waited, action)
+            WAIT_DURATION.increment(waited, action=action)
+        return True
@@ -0,0 +1,65 @@
+import collections
+import logging
+import peewee
+from .clock import Clock
+from .db import run_in_db
+from .user import User
+
+LOGGER = logging.getLogger('instabot.candidate_counters')
+RECONCILIATION_INTERVAL = 60 * 60
+
+
+class CandidateCounters:
+    """In-memory counts of users to follow by following depth.
+
+    Services update counters on every insert, follow and skip, so checking
+    whether there're enough users to follow doesn't touch DB. The counters
+    are reconciled with DB from time to time to fix drift caused by other
+    processes.
+
+    """
+    _instance = None
+
+    def __init__(self, clock=None):
+        self._clock = Clock() if clock is None else clock
+        self._counts = collections.Counter()
+        type(self)._instance = self
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    def add(self, following_depth, count=1):
+        self._counts[following_depth] += count
+
+    def remove(self, following_depth, count=1):
+        self._counts[following_depth] = \
+            max(0, self._counts[following_depth] - count)
+
+    def reconcile(self):
+        """Recounts users to follow in DB."""
+        counts = collections.Counter(dict(
+            User
+            .select(User.following_depth, peewee.fn.COUNT(User.id))
+            .where(User.state == User.CANDIDATE)
+            .group_by(User.following_depth)
+            .tuples()
+            ))
+        if counts != self._counts:
+            LOGGER.debug(
+                'Users to follow counts were %s, DB has %s',
+                dict(self._counts),
+                dict(counts),
+                )
+        self._counts = counts
+
+    async def run(self):
+        while True:
+            await self._clock.sleep(RECONCILIATION_INTERVAL)
+            try:
+                await run_in_db(self.reconcile)
+            except peewee.PeeweeException as e:
+                LOGGER.warning('Can\'t reconcile counters: %s', e)
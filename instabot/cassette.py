@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import gzip
+import http.cookies
+import json
+import re
+import urllib.parse
+
+CSRF_TOKEN_RE = re.compile(r'("csrf_token"\s*:\s*")[^"]*(")')
+ID_RE = re.compile(r'/\d+/')
+QUERY_FIELD_RE = re.compile(r'\)\s*\{\s*(\w+)')
+TAG_RE = re.compile(r'/explore/tags/[^/]+/')
+SANITIZED = 'sanitized'
+
+
+def get_request_key(method, url, data=None):
+    """
+    Returns:
+        str: Key identifying the kind of the request, e.g.
+        'POST /query/ followed_by'.
+
+    """
+    path = urllib.parse.urlsplit(url).path
+    path = TAG_RE.sub('/explore/tags/{tag}/', ID_RE.sub('/{id}/', path))
+    key = '{} {}'.format(method, path)
+    if data is not None and 'q' in data:
+        match = QUERY_FIELD_RE.search(data['q'])
+        if match is not None:
+            key = '{} {}'.format(key, match.group(1))
+    return key
+
+
+class CassetteRecorder:
+    """Appends responses to the cassette.
+
+    Cassette is a gzipped file with a JSON object per line. Every object
+    holds the key of the request, response status, names of cookies set by
+    the response and response body. Requests themselves aren't saved and
+    secrets are removed from the bodies, so cassettes may be shared.
+
+    Args:
+        filename (str)
+        secrets (iterable): Strings to remove from responses, e.g.
+            credentials.
+
+    """
+
+    def __init__(self, filename, secrets=()):
+        self._file = gzip.open(filename, 'at', encoding='utf-8')
+        self._secrets = [secret for secret in secrets if secret]
+
+    def close(self):
+        self._file.close()
+
+    def record(self, key, status, cookies, body):
+        """
+        Args:
+            key (str): Value returned by `get_request_key`.
+            status (int)
+            cookies (iterable): Names of cookies set by the response.
+            body (str)
+
+        """
+        body = CSRF_TOKEN_RE.sub(r'\1{}\2'.format(SANITIZED), body)
+        for secret in self._secrets:
+            body = body.replace(secret, SANITIZED)
+        json.dump(
+            {
+                'body': body,
+                'cookies': sorted(cookies),
+                'key': key,
+                'status': status,
+                },
+            self._file,
+            ensure_ascii=False,
+            )
+        self._file.write('\n')
+        self._file.flush()
+
+
+class ReplaySession:
+    """Replacement of `aiohttp.ClientSession` which serves responses from
+    the cassette.
+
+    Responses to requests of the same kind are served in the recorded order
+    and cyclically.
+
+    Args:
+        filename (str): Cassette.
+
+    Raises:
+        KeyError: On a request of the kind which wasn't recorded.
+
+    """
+
+    def __init__(self, filename):
+        self.cookies = http.cookies.SimpleCookie()
+        self._responses = collections.defaultdict(collections.deque)
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            for line in f:
+                response = json.loads(line)
+                self._responses[response['key']].append(response)
+
+    def close(self):
+        pass
+
+    def detach(self):
+        pass
+
+    def get(self, url, headers=None):
+        return _ReplayRequest(self._respond(get_request_key('GET', url)))
+
+    def post(self, url, data=None, headers=None):
+        return _ReplayRequest(
+            self._respond(get_request_key('POST', url, data)),
+            )
+
+    def _respond(self, key):
+        responses = self._responses[key]
+        if not responses:
+            raise KeyError('No responses for {} were recorded'.format(key))
+        response = responses[0]
+        responses.rotate(-1)
+        for name in response['cookies']:
+            self.cookies[name] = SANITIZED
+        return _ReplayResponse(response['status'], response['body'])
+
+
+class _ReplayContent:
+    def __init__(self, body):
+        self._body = body
+        self._position = 0
+
+    async def read(self, size=-1):
+        if size < 0:
+            size = len(self._body) - self._position
+        chunk = self._body[self._position:self._position + size]
+        self._position += len(chunk)
+        return chunk
+
+
+class _ReplayRequest:
+    def __init__(self, response):
+        self._response = response
+
+    def __await__(self):
+        return self._get_response().__await__()
+
+    async def __aenter__(self):
+        return self._response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._response.close()
+
+    async def _get_response(self):
+        await asyncio.sleep(0)
+        return self._response
+
+
+class _ReplayResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self._body = body
+        self.content = _ReplayContent(body.encode('utf-8'))
+
+    def close(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def text(self):
+        return self._body
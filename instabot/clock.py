@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+
+
+class Clock:
+    """Source of current time and sleeps used by the client and services."""
+
+    def now(self):
+        """
+        Returns:
+            datetime.datetime: Current UTC time.
+
+        """
+        return datetime.datetime.utcnow()
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+
+class VirtualClock(Clock):
+    """Clock which advances instantly when everybody sleeps.
+
+    Sleeping coroutines are woken up in order of their wake up time by `run`
+    coroutine. Time is advanced when no coroutine has started or finished
+    sleeping during `idle_time` real seconds, so the coroutine doing some I/O
+    for longer than `idle_time` may observe time jump. Sleeps outside of
+    `run`, e.g. during setup with `run_until_complete`, advance the time at
+    once because nobody else could wake them up.
+
+    Args:
+        start (datetime.datetime, optional): Initial time. Current UTC time
+            by default.
+        idle_time (float): Real seconds of inactivity after which virtual
+            time is advanced.
+
+    """
+
+    def __init__(self, start=None, idle_time=0.005):
+        self._start = datetime.datetime.utcnow() if start is None else start
+        self._idle_time = idle_time
+        self._time = 0
+        self._sleepers = []
+        self._sleepers_counter = itertools.count()
+        self._activity = 0
+        self._is_running = False
+
+    def now(self):
+        return self._start + datetime.timedelta(seconds=self._time)
+
+    async def sleep(self, delay):
+        if delay <= 0:
+            await asyncio.sleep(0)
+            return
+        if not self._is_running:
+            self._time += delay
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(
+            self._sleepers,
+            (self._time + delay, next(self._sleepers_counter), future),
+            )
+        self._activity += 1
+        await future
+
+    def run(self, duration):
+        """Advances virtual time until `duration` seconds pass.
+
+        The clock counts as running since the call, so coroutines which
+        start together with the returned one sleep in virtual time.
+
+        Args:
+            duration (float): Virtual seconds to run for.
+
+        Returns:
+            coroutine
+
+        """
+        self._is_running = True
+        return self._advance(self._time + duration)
+
+    async def _advance(self, finish):
+        try:
+            while self._time < finish:
+                activity = self._activity
+                await asyncio.sleep(self._idle_time)
+                if activity != self._activity:
+                    continue
+                if not self._sleepers:
+                    # Nobody can be woken up by the clock anymore.
+                    self._time = finish
+                    break
+                self._time = min(max(self._sleepers[0][0], self._time), finish)
+                while self._sleepers and self._sleepers[0][0] <= self._time:
+                    _, _, future = heapq.heappop(self._sleepers)
+                    if not future.done():
+                        future.set_result(None)
+                        self._activity += 1
+        finally:
+            self._is_running = False
@@ -1,5 +1,6 @@
 import logging
 import sys
+import tempfile
 import yaml
 
 LOGGER = logging.getLogger('instabot.configuration')
@@ -36,14 +37,68 @@ class Configuration:
                 'Configuration is not fully specified. {} is missed.'
                 .format(e),
                 )
+        self.db_max_connections = configuration['db'] \
+            .get('max_connections', 4)
+        self.db_stale_timeout = configuration['db'].get('stale_timeout', 3600)
+        diagnostics = configuration.get('diagnostics', {})
+        self.diagnostics_profile_directory = diagnostics.get(
+            'profile_directory',
+            tempfile.gettempdir(),
+            )
+        self.diagnostics_slow_callback_duration = diagnostics.get(
+            'slow_callback_duration',
+            0.5,
+            )
         self.hashtags = configuration.get('hashtags', [])
+        self.instagram_actions_burst = configuration['instagram'] \
+            .get('actions_burst', 1)
+        self.instagram_actions_per_hour = configuration['instagram'] \
+            .get('actions_per_hour', {})
+        self.instagram_cassette = configuration['instagram'].get('cassette')
+        self.instagram_connections_limit = configuration['instagram'] \
+            .get('connections_limit', 4)
+        self.instagram_keepalive_timeout = configuration['instagram'] \
+            .get('keepalive_timeout', 30)
+        self.instagram_session_file = configuration['instagram'] \
+            .get('session_file')
+        metrics = configuration.get('metrics', {})
+        self.metrics_host = metrics.get('host', '127.0.0.1')
+        self.metrics_port = metrics.get('port')
+        scheduler = configuration.get('scheduler', {})
+        self.scheduler_latency_targets = scheduler.get('latency_targets', {})
+        self.scheduler_weights = scheduler.get('weights', {})
+        self.scheduler_workers = scheduler.get('workers', 4)
         self.users_to_follow_cache_size = configuration.get(
             'users_to_follow_cache_size',
             0,
             )
         try:
+            self.db_max_connections = int(self.db_max_connections)
+            self.db_stale_timeout = int(self.db_stale_timeout)
+            self.diagnostics_slow_callback_duration = \
+                float(self.diagnostics_slow_callback_duration)
             self.following_hours = int(self.following_hours)
+            self.instagram_actions_burst = int(self.instagram_actions_burst)
+            self.instagram_actions_per_hour = {
+                action: float(per_hour)
+                for action, per_hour in self.instagram_actions_per_hour.items()
+                }
+            self.instagram_connections_limit = \
+                int(self.instagram_connections_limit)
+            self.instagram_keepalive_timeout = \
+                int(self.instagram_keepalive_timeout)
+            self.scheduler_latency_targets = {
+                kind: int(target)
+                for kind, target in self.scheduler_latency_targets.items()
+                }
+            self.scheduler_weights = {
+                kind: float(weight)
+                for kind, weight in self.scheduler_weights.items()
+                }
+            self.scheduler_workers = int(self.scheduler_workers)
             self.users_to_follow_cache_size = \
                 int(self.users_to_follow_cache_size)
-        except ValueError as e:
+            if self.metrics_port is not None:
+                self.metrics_port = int(self.metrics_port)
+        except (AttributeError, TypeError, ValueError) as e:
             sys.exit('Some integer value is specified wrong: {}'.format(e))
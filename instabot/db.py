@@ -1,20 +1,72 @@
+import asyncio
+import functools
 import logging
 import sys
+import time
+from .metrics import REGISTRY
+from concurrent.futures import ThreadPoolExecutor
 from instabot import user
 from peewee import *
+from playhouse.pool import PooledDatabase, PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
 
+# The running bot does all DB work in this single thread, so slow queries
+# don't block the event loop while peewee keeps one connection for them.
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
 LOGGER = logging.getLogger('instabot')
+POOL_CONNECTIONS = REGISTRY.gauge(
+    'instabot_db_pool_connections',
+    'DB connections in the pool by state.',
+    )
+POOL_DISCARDED_CONNECTIONS = REGISTRY.counter(
+    'instabot_db_pool_discarded_connections_total',
+    'Pooled DB connections which have failed health check.',
+    )
+QUERY_DURATION = REGISTRY.histogram(
+    'instabot_db_query_duration_seconds',
+    'Time spent in DB queries.',
+    )
 
 
-class RetryingMySQLDatabase(RetryOperationalError, MySQLDatabase):
+class RetryingMySQLDatabase(RetryOperationalError, PooledMySQLDatabase):
     """
-    Automatically reconnecting database class.
+    Automatically reconnecting database class with connection pool.
+
+    Connections are pinged before being taken from the pool and are recycled
+    after `stale_timeout` seconds.
     @see {@link
     http://docs.peewee-orm.com/en/latest/peewee/database.html#automatic
     -reconnect}
+    @see {@link
+    http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#pool}
     """
 
+    def _is_closed(self, key, conn):
+        is_closed = super(RetryingMySQLDatabase, self)._is_closed(key, conn)
+        if is_closed:
+            POOL_DISCARDED_CONNECTIONS.increment()
+        return is_closed
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        started = time.perf_counter()
+        try:
+            return super(RetryingMySQLDatabase, self) \
+                .execute_sql(sql, params, require_commit)
+        finally:
+            QUERY_DURATION.observe(time.perf_counter() - started)
+
+    def get_pool_stats(self):
+        """
+        Returns:
+            dict: Numbers of connections in use and idle ones and the limit.
+
+        """
+        return {
+            'idle': len(self._connections),
+            'in_use': len(self._in_use),
+            'max': self.max_connections,
+            }
+
     def sequence_exists(self, seq):
         pass
 
@@ -28,6 +80,8 @@ def get_db(configuration):
         host=configuration.db_host,
         user=configuration.db_user,
         password=configuration.db_password,
+        max_connections=configuration.db_max_connections,
+        stale_timeout=configuration.db_stale_timeout,
         )
     # Connect to database just to check if configuration has errors.
     try:
@@ -36,4 +90,40 @@ def get_db(configuration):
         sys.exit('DatabaseError during connecting to database: {0}'.format(e))
     db.close()
     user.database_proxy.initialize(db)
+    REGISTRY.add_collector(functools.partial(_collect_pool_stats, db))
     return db
+
+
+def _call_with_connection(func):
+    """Calls `func` and returns DB connection to the pool after that."""
+    database = user.database_proxy.obj
+    try:
+        return func()
+    finally:
+        if isinstance(database, PooledDatabase) and \
+                not database.is_closed():
+            database.close()
+
+
+def _collect_pool_stats(db):
+    for state, count in db.get_pool_stats().items():
+        POOL_CONNECTIONS.set(count, state=state)
+
+
+async def run_in_db(func, *args, **kwargs):
+    """Calls `func` in the DB thread without blocking the event loop.
+
+    Coroutines should use it for every operation with models.
+
+    Returns:
+        The result of `func`.
+
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        EXECUTOR,
+        functools.partial(
+            _call_with_connection,
+            functools.partial(func, *args, **kwargs),
+            ),
+        )
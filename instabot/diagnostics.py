@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from .metrics import REGISTRY
+
+LAG = REGISTRY.histogram(
+    'instabot_loop_lag_seconds',
+    'Delay of event loop callbacks against their scheduled time.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    )
+LAG_PERCENTILES = (50, 90, 99)
+LOGGER = logging.getLogger('instabot.diagnostics')
+REPORT_INTERVAL = 5 * 60
+SAMPLING_INTERVAL = 0.005
+TICK_INTERVAL = 0.5
+WATCHDOG_INTERVAL = 0.1
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    # Python 3.6.
+    _current_task = asyncio.Task.current_task
+
+
+class LoopMonitor:
+    """Measures event loop lag and reports callbacks which block the loop.
+
+    The lag is measured by a coroutine which wakes up every `TICK_INTERVAL`
+    seconds. Blocking callbacks are caught by a watchdog thread which pings
+    the loop and logs the stack of the loop thread if the ping isn't handled
+    in `slow_callback_duration` seconds.
+
+    Args:
+        configuration (Configuration)
+
+    """
+
+    def __init__(self, configuration):
+        self._slow_callback_duration = \
+            configuration.diagnostics_slow_callback_duration
+        self._lags = []
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        watchdog = threading.Thread(
+            target=self._watch,
+            args=(loop, threading.get_ident()),
+            name='instabot-watchdog',
+            daemon=True,
+            )
+        watchdog.start()
+        reported = loop.time()
+        while True:
+            expected = loop.time() + TICK_INTERVAL
+            await asyncio.sleep(TICK_INTERVAL)
+            now = loop.time()
+            lag = max(0, now - expected)
+            LAG.observe(lag)
+            self._lags.append(lag)
+            if now - reported >= REPORT_INTERVAL:
+                self._report()
+                reported = now
+
+    def _report(self):
+        lags = sorted(self._lags)
+        self._lags.clear()
+        LOGGER.info(
+            'Event loop lag: %s, max %.3f sec',
+            ', '.join(
+                'p{} {:.3f}'.format(
+                    percentile,
+                    lags[min(len(lags) - 1, len(lags) * percentile // 100)],
+                    )
+                for percentile in LAG_PERCENTILES
+                ),
+            lags[-1],
+            )
+
+    def _watch(self, loop, loop_thread_id):
+        while True:
+            started = time.monotonic()
+            handled = threading.Event()
+            loop.call_soon_threadsafe(handled.set)
+            if not handled.wait(self._slow_callback_duration):
+                frame = sys._current_frames().get(loop_thread_id)
+                task = _current_task(loop=loop)
+                LOGGER.warning(
+                    'Event loop is blocked for more than %.2f sec by %r:\n%s',
+                    self._slow_callback_duration,
+                    task,
+                    ''.join(traceback.format_stack(frame)),
+                    )
+                handled.wait()
+                LOGGER.warning(
+                    'Event loop was blocked for %.2f sec',
+                    time.monotonic() - started,
+                    )
+            time.sleep(WATCHDOG_INTERVAL)
+
+
+class SamplingProfiler:
+    """Sampling profiler which may be toggled in the running process.
+
+    Stacks of all threads are sampled every `SAMPLING_INTERVAL` seconds. When
+    profiling is stopped, the samples are saved in collapsed stacks format
+    understood by `flamegraph.pl` and speedscope.
+
+    Args:
+        configuration (Configuration)
+
+    """
+
+    def __init__(self, configuration):
+        self._directory = configuration.diagnostics_profile_directory
+        self._stopping = None
+
+    def toggle(self):
+        if self._stopping is None:
+            self._stopping = threading.Event()
+            threading.Thread(
+                target=self._sample,
+                args=(self._stopping,),
+                name='instabot-profiler',
+                daemon=True,
+                ).start()
+            LOGGER.info('Profiling was started')
+        else:
+            self._stopping.set()
+            self._stopping = None
+
+    def _sample(self, stopping):
+        stacks = collections.Counter()
+        profiler_thread_id = threading.get_ident()
+        while not stopping.wait(SAMPLING_INTERVAL):
+            thread_names = {
+                thread.ident: thread.name
+                for thread in threading.enumerate()
+                }
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == profiler_thread_id:
+                    continue
+                stacks[_collapse(
+                    thread_names.get(thread_id, str(thread_id)),
+                    frame,
+                    )] += 1
+        filename = os.path.join(
+            self._directory,
+            'instabot-{}-{}.folded'.format(
+                os.getpid(),
+                time.strftime('%Y%m%d-%H%M%S'),
+                ),
+            )
+        try:
+            with open(filename, 'w') as f:
+                for stack, count in stacks.items():
+                    f.write('{} {}\n'.format(stack, count))
+        except OSError as e:
+            LOGGER.warning('Can\'t save profile: %s', e)
+        else:
+            LOGGER.info('Profile was saved to %s', filename)
+
+
+def _collapse(thread_name, frame):
+    """
+    Returns:
+        str: Semicolon-separated frames of the stack from its root.
+
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append('{} ({}:{})'.format(
+            code.co_name,
+            code.co_filename,
+            code.co_firstlineno,
+            ).replace(';', ':'))
+        frame = frame.f_back
+    frames.append(thread_name.replace(' ', '_'))
+    return ';'.join(reversed(frames))
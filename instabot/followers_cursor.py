@@ -0,0 +1,26 @@
+import datetime
+from .user import database_proxy, User
+from peewee import *
+
+
+class FollowersCursor(Model):
+    """Position of the followers crawl of certain user.
+
+    Allows to continue fetching followers of the user from the last fetched
+    page across crawling cycles and restarts.
+
+    """
+    user = ForeignKeyField(
+        User,
+        on_delete='CASCADE',
+        primary_key=True,
+        related_name='followers_cursors',
+        )
+    # `None` means that the crawl should start from the first page.
+    end_cursor = CharField(max_length=255, null=True)
+    fetched_count = IntegerField(default=0)
+    new_count = IntegerField(default=0)
+    updated = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        database = database_proxy
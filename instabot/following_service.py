@@ -1,37 +1,77 @@
 import asyncio
+import collections
 import datetime
+import heapq
 import logging
+import peewee
+from .candidate_counters import CandidateCounters
+from .clock import Clock
+from .db import run_in_db
 from .errors import APIError, APIJSONError, APILimitError, \
     APINotAllowedError, APINotFoundError, APIFailError
+from .scheduler import Scheduler
 from .stats_service import StatsService
 from .user import User
 from aiohttp.errors import ClientResponseError
+from playhouse.shortcuts import case
 
+BATCH_SIZE = 20
+# How often unfollowing deadlines are reloaded from DB to catch up with
+# users followed by other processes.
+DEADLINES_RELOAD_INTERVAL = datetime.timedelta(hours=1)
+# How often users to follow are checked against users followed already.
+FOLLOWED_RECONCILIATION_INTERVAL = datetime.timedelta(hours=6)
 LOGGER = logging.getLogger('instabot.following_service')
 
 
 class FollowingService:
-    def __init__(self, client, configuration):
+    def __init__(self, client, configuration, clock=None):
+        self._candidate_counters = CandidateCounters.get_instance()
         self._client = client
+        self._clock = Clock() if clock is None else clock
+        self._followed_reconciled_at = None
         self._following_timedelta = \
             datetime.timedelta(hours=configuration.following_hours)
+        self._own_user = User(
+            instagram_id=client.id,
+            username=configuration.instagram_username,
+            )
+        self._scheduler = Scheduler.get_instance()
         self._stats_service = StatsService.get_instance()
+        # Min-heap of (unfollowing deadline, user ID) of followed users.
+        self._deadlines = []
+        # Wakes up unfollowing when new deadlines are pushed.
+        self._deadlines_pushed = asyncio.Event()
+        self._deadlines_loaded_at = None
 
     async def run(self):
+        # Due unfollows shouldn't wait for the long following pass.
+        await asyncio.gather(
+            self._run_forever(self._unfollow, idle_time=0),
+            self._run_forever(self._follow, idle_time=10),
+            self._run_forever(self._reconcile_followed, idle_time=0),
+            )
+
+    async def _run_forever(self, step, idle_time):
         while True:
             try:
-                await self._unfollow()
-                await self._follow()
+                await step()
             except APILimitError as e:
                 LOGGER.debug(e)
             except (APIError, APIJSONError) as e:
                 LOGGER.debug(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
+            except APINotAllowedError as e:
+                LOGGER.warning(e)
+                await self._clock.sleep(60)
             except (IOError, OSError, ClientResponseError) as e:
                 LOGGER.warning(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
+            except peewee.PeeweeException as e:
+                LOGGER.warning('Can\'t access DB: %s', e)
+                await self._clock.sleep(60)
             else:
-                await asyncio.sleep(10)
+                await self._clock.sleep(idle_time)
 
     async def _follow(self):
         """
@@ -39,27 +79,207 @@ class FollowingService:
         @raise APIJSONError
         @raise APILimitError
         """
-        unfollowing_threshold = datetime.datetime.utcnow() - \
+        unfollowing_threshold = self._clock.now() - \
             self._following_timedelta
-        for user in User.select().where(
-                        User.was_followed_at == None,
-                ).order_by(User.following_depth, User.created):
+        last_user = None
+        while True:
+            users = await run_in_db(self._get_users_to_follow, last_user)
+            if not users:
+                break
+            # User ID -> (state, was_followed_at)
+            states = {}
             try:
-                await self._client.follow(user)
-            except (APINotAllowedError, APINotFoundError) as e:
-                LOGGER.debug('Can\'t follow {}. {}'.format(user.username, e))
-                # Make user look like he was followed and was unfollowed
-                # already.
-                user.is_followed = False
-                user.was_followed_at = unfollowing_threshold
-            else:
-                user.is_followed = True
-                user.was_followed_at = datetime.datetime.utcnow()
-                self._stats_service.increment('followed')
-            user.save()
+                for user in users:
+                    try:
+                        await self._scheduler.submit(
+                            'follow',
+                            self._client.follow,
+                            user,
+                            )
+                    except (APINotAllowedError, APINotFoundError) as e:
+                        LOGGER.debug('Can\'t follow %s. %s', user.username, e)
+                        # Make user look like he was followed and was
+                        # unfollowed already.
+                        states[user.id] = User.FINISHED, unfollowing_threshold
+                    else:
+                        states[user.id] = User.FOLLOWED, self._clock.now()
+                        self._stats_service.increment('followed')
+            finally:
+                if states:
+                    await run_in_db(self._save_following_states, states)
+                    # Deadlines are pushed only when they're in DB, so
+                    # reloading deadlines concurrently can't drop them.
+                    for user_id, (state, was_followed_at) in states.items():
+                        if state == User.FOLLOWED:
+                            heapq.heappush(self._deadlines, (
+                                was_followed_at + self._following_timedelta,
+                                user_id,
+                                ))
+                            self._deadlines_pushed.set()
+                    for user in users:
+                        if user.id in states:
+                            self._candidate_counters.remove(
+                                user.following_depth,
+                                )
+            last_user = users[-1]
+
+    def _get_users_to_follow(self, last_user=None):
+        """Returns next batch of users to follow, the most likely to follow
+        back first.
+
+        Only fields needed for following are fetched.
+
+        Args:
+            last_user (User, optional): The last user of the previous batch.
+
+        """
+        query = User \
+            .select(
+                User.id,
+                User.created,
+                User.follow_back_rank,
+                User.following_depth,
+                User.instagram_id,
+                User.username,
+                ) \
+            .where(User.state == User.CANDIDATE)
+        if last_user is not None:
+            query = query.where(
+                peewee.Tuple(User.follow_back_rank, User.created, User.id) >
+                peewee.Tuple(
+                    last_user.follow_back_rank,
+                    last_user.created,
+                    last_user.id,
+                    ),
+                )
+        return list(
+            query
+            .order_by(User.follow_back_rank, User.created, User.id)
+            .limit(BATCH_SIZE)
+            )
+
+    def _finish_followed(self, instagram_ids):
+        """Finishes users to follow among given followed ones.
+
+        Returns:
+            collections.Counter: Following depth -> number of finished users.
+
+        """
+        users = list(
+            User
+            .select(User.id, User.following_depth)
+            .where(
+                (User.instagram_id << instagram_ids) &
+                (User.state == User.CANDIDATE),
+                )
+            .tuples()
+            )
+        if users:
+            User \
+                .update(state=User.FINISHED) \
+                .where(User.id << [user_id for user_id, _ in users]) \
+                .execute()
+        return collections.Counter(
+            following_depth for _, following_depth in users
+            )
+
+    def _get_deadlines(self):
+        """Returns heap of unfollowing deadlines of all followed users."""
+        deadlines = [
+            (was_followed_at + self._following_timedelta, user_id)
+            for user_id, was_followed_at in User
+            .select(User.id, User.was_followed_at)
+            .where(User.state == User.FOLLOWED)
+            .tuples()
+            .iterator()
+            ]
+        heapq.heapify(deadlines)
+        return deadlines
+
+    def _get_users_to_unfollow(self, user_ids):
+        """Returns still followed users among given ones.
+
+        Only fields needed for unfollowing are fetched.
+
+        """
+        return list(
+            User
+            .select(User.id, User.instagram_id, User.username)
+            .where((User.id << user_ids) & (User.state == User.FOLLOWED))
+            .order_by(User.id)
+            )
+
+    async def _reconcile_followed(self):
+        """Finishes users to follow who are followed already and sleeps until
+        the next reconciliation.
+
+        Users could be followed outside of the bot after they were fetched.
+        Following them again would waste an action.
+
+        Raises:
+            APIError
+            APIJSONError
+            APILimitError
+
+        """
+        now = self._clock.now()
+        if self._followed_reconciled_at is not None:
+            wake_up_at = self._followed_reconciled_at + \
+                FOLLOWED_RECONCILIATION_INTERVAL
+            if now < wake_up_at:
+                await self._clock.sleep((wake_up_at - now).total_seconds())
+        # Failed reconciliation waits for the next interval too.
+        self._followed_reconciled_at = self._clock.now()
+        finished_count = 0
+        pages = self._client.iter_followed(self._own_user)
+        try:
+            while True:
+                # Every page is a separate work item for the scheduler.
+                try:
+                    followed_json = await self._scheduler.submit(
+                        'crawl',
+                        pages.__anext__,
+                        )
+                except StopAsyncIteration:
+                    break
+                counts = await run_in_db(
+                    self._finish_followed,
+                    [followed['id'] for followed in followed_json],
+                    )
+                for following_depth, count in counts.items():
+                    self._candidate_counters.remove(following_depth, count)
+                    finished_count += count
+        finally:
+            await pages.aclose()
+        LOGGER.debug(
+            '%d users to follow were followed already',
+            finished_count,
+            )
+
+    def _save_following_states(self, states):
+        """Saves results of following of users batch with single UPDATE.
+
+        Args:
+            states (dict): User ID -> (state, was_followed_at).
+
+        """
+        User \
+            .update(
+                state=case(
+                    User.id,
+                    [(user_id, state[0]) for user_id, state in states.items()],
+                    ),
+                was_followed_at=case(
+                    User.id,
+                    [(user_id, state[1]) for user_id, state in states.items()],
+                    ),
+                ) \
+            .where(User.id << list(states)) \
+            .execute()
 
     async def _unfollow(self):
-        """Tries to unfollow all of the users that should be unfollowed.
+        """Unfollows users whose deadlines have come and sleeps until the next
+        deadline.
 
         Raises:
             APIError
@@ -67,24 +287,93 @@ class FollowingService:
             APILimitError
 
         """
-        unfollowing_threshold = datetime.datetime.utcnow() - \
-            self._following_timedelta
-        for user in User.select().where(
-                (User.is_followed == True) &
-                (User.was_followed_at <= unfollowing_threshold),
-                ):
-            try:
-                await self._client.unfollow(user)
-            except APIFailError as e:
-                LOGGER.info(
-                    'It seems like {} can\'t be unfollowed properly. '
-                    'Skipping her. {}'
-                    .format(user.username, e)
+        now = self._clock.now()
+        if self._deadlines_loaded_at is None or \
+                now - self._deadlines_loaded_at >= DEADLINES_RELOAD_INTERVAL:
+            self._deadlines = await run_in_db(self._get_deadlines)
+            self._deadlines_loaded_at = now
+            LOGGER.debug(
+                '%d unfollowing deadlines were loaded',
+                len(self._deadlines),
+                )
+        while self._deadlines and self._deadlines[0][0] <= now:
+            due = []
+            while self._deadlines and self._deadlines[0][0] <= now and \
+                    len(due) < BATCH_SIZE:
+                due.append(heapq.heappop(self._deadlines))
+            await self._unfollow_due(due)
+            now = self._clock.now()
+        # Deadlines of users followed from now on aren't earlier than the
+        # heap head, so the head is the next deadline unless the heap is
+        # empty. Following wakes this loop up in the latter case.
+        wake_up_at = self._deadlines_loaded_at + DEADLINES_RELOAD_INTERVAL
+        if self._deadlines:
+            wake_up_at = min(wake_up_at, self._deadlines[0][0])
+        await self._sleep_until(wake_up_at)
+
+    async def _sleep_until(self, wake_up_at):
+        """Sleeps until given time or until new deadlines are pushed."""
+        self._deadlines_pushed.clear()
+        sleep = asyncio.ensure_future(self._clock.sleep(
+            (wake_up_at - self._clock.now()).total_seconds(),
+            ))
+        pushed = asyncio.ensure_future(self._deadlines_pushed.wait())
+        try:
+            await asyncio.wait(
+                [sleep, pushed],
+                return_when=asyncio.FIRST_COMPLETED,
+                )
+        finally:
+            sleep.cancel()
+            pushed.cancel()
+
+    async def _unfollow_due(self, due):
+        """Unfollows users with given deadlines.
+
+        Deadlines of users which weren't processed because of an error are
+        pushed back to the heap.
+
+        Args:
+            due (list): (deadline, user ID) tuples.
+
+        """
+        deadlines = {user_id: deadline for deadline, user_id in due}
+        users = await run_in_db(self._get_users_to_unfollow, list(deadlines))
+        unfollowed_ids = []
+        try:
+            for user in users:
+                try:
+                    await self._scheduler.submit(
+                        'unfollow',
+                        self._client.unfollow,
+                        user,
+                        )
+                except APIFailError as e:
+                    LOGGER.info(
+                        'It seems like %s can\'t be unfollowed properly. '
+                        'Skipping her. %s',
+                        user.username,
+                        e,
+                        )
+                    self._stats_service.increment('unfollowed')
+                except (APINotAllowedError, APINotFoundError) as e:
+                    LOGGER.debug(
+                        'Can\'t unfollow %s. %s',
+                        user.username,
+                        e,
+                        )
+                else:
+                    self._stats_service.increment('unfollowed')
+                unfollowed_ids.append(user.id)
+        finally:
+            for user in users[len(unfollowed_ids):]:
+                heapq.heappush(
+                    self._deadlines,
+                    (deadlines[user.id], user.id),
+                    )
+            if unfollowed_ids:
+                await run_in_db(
+                    User.update(state=User.FINISHED)
+                    .where(User.id << unfollowed_ids)
+                    .execute,
                     )
-                self._stats_service.increment('unfollowed')
-            except (APINotAllowedError, APINotFoundError) as e:
-                LOGGER.debug('Can\'t unfollow {}. {}'.format(user.username, e))
-            else:
-                self._stats_service.increment('unfollowed')
-            user.is_followed = False
-            user.save()
@@ -0,0 +1,89 @@
+import json
+import re
+from .errors import APIError
+
+MEDIA_KEY = '"edge_hashtag_to_media"'
+SCRIPT_END = b';</script>'
+SHARED_DATA_RE = re.compile(
+    rb'<script type="text/javascript">[\w\.]+\s*=\s*(?=\{)',
+    )
+# Longest prefix of the script start which may be split between chunks.
+SHARED_DATA_START_MAX = 128
+
+
+class HashtagPageParser:
+    """Extracts media IDs from `explore/tags/` page fed chunk by chunk.
+
+    Only the script containing page data is buffered, the rest of the page is
+    dropped as soon as it's scanned. Only `edge_hashtag_to_media` object is
+    decoded from that script.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data = None
+        self._is_data_started = False
+        self._scanned = 0
+
+    def feed(self, chunk):
+        """Consumes next chunk of the page.
+
+        Returns:
+            bool: True if page data was found and the rest of the page isn't
+            needed.
+
+        """
+        if self._data is not None:
+            return True
+        self._buffer.extend(chunk)
+        if not self._is_data_started:
+            match = SHARED_DATA_RE.search(self._buffer)
+            if match is None:
+                # Keep only the tail which can contain the beginning of the
+                # script.
+                del self._buffer[:-SHARED_DATA_START_MAX]
+                return False
+            del self._buffer[:match.end()]
+            self._is_data_started = True
+        end = self._buffer.find(
+            SCRIPT_END,
+            max(0, self._scanned - len(SCRIPT_END)),
+            )
+        if end == -1:
+            self._scanned = len(self._buffer)
+            return False
+        self._data = self._buffer[:end].decode('utf-8', errors='ignore')
+        self._buffer = None
+        return True
+
+    def get_media(self):
+        """
+        Returns:
+            List of media IDs (strings).
+
+        Raises:
+            APIError: If page data wasn't found or has unexpected structure.
+
+        """
+        if self._data is None:
+            raise APIError('Can\'t find JSON in the response')
+        key_position = self._data.find(MEDIA_KEY)
+        if key_position == -1:
+            raise APIError('Can\'t find media in the response JSON')
+        object_position = self._data.find('{', key_position + len(MEDIA_KEY))
+        if object_position == -1:
+            raise APIError('Can\'t find media in the response JSON')
+        try:
+            media, _ = json.JSONDecoder().raw_decode(
+                self._data,
+                object_position,
+                )
+        except ValueError as e:
+            raise APIError('Can\'t parse response JSON: {}'.format(e))
+        try:
+            return [edge['node']['id'] for edge in media['edges']]
+        except (KeyError, TypeError) as e:
+            raise APIError(
+                'Can\'t obtain media from response JSON: {}'.format(e),
+                )
@@ -1,13 +1,27 @@
 import asyncio
 import datetime
 import logging
-import logging.config
+import peewee
+import signal
+import sys
+from .archive_service import ArchiveService
+from .archived_user import ArchivedUser
+from .budget import Budget
+from .candidate_counters import CandidateCounters
+from .cassette import CassetteRecorder
 from .configuration import Configuration
-from .db import get_db
+from .diagnostics import LoopMonitor, SamplingProfiler
+from .db import get_db, run_in_db
 from .errors import ConfigurationError
+from .followers_cursor import FollowersCursor
 from .following_service import FollowingService
+from .known_users import KnownUsers
 from .like_service import LikeService
+from .logging_pipeline import configure_logging
 from .media_service import MediaService
+from .metrics import MetricsService
+from .migration import migrate
+from .scheduler import Scheduler
 from .stats_service import StatsService
 from .user import User
 from .user_service import UserService
@@ -21,6 +35,7 @@ DOC = '''InstaBot
 Usage:
   instabot CONFIGURATION
   instabot install CONFIGURATION
+  instabot migrate CONFIGURATION
   instabot unfollow CONFIGURATION
   instabot -h | --help | --version
 
@@ -33,18 +48,29 @@ __version__ = '0.4.1'
 
 def install(configuration, db):
     LOGGER.info('Installing InstaBot')
-    db.create_tables([User])
+    db.create_tables([User, FollowersCursor, ArchivedUser], safe=True)
     client = instagram.Client(configuration)
+    if ArchivedUser.select().where(
+            ArchivedUser.instagram_id == client.id,
+            ).exists():
+        LOGGER.info('InstaBot was installed already')
+        return
     now = datetime.datetime.utcnow()
     was_followed_at = now - \
         datetime.timedelta(hours=configuration.following_hours)
-    user = User.create(
-        following_depth=0,
-        instagram_id=client.id,
-        username=configuration.instagram_username,
-        # To prevent attempts to follow user by himself.
-        was_followed_at=was_followed_at,
-        )
+    try:
+        User.create(
+            following_depth=0,
+            instagram_id=client.id,
+            # To prevent attempts to follow user by himself.
+            state=User.FINISHED,
+            username=configuration.instagram_username,
+            was_followed_at=was_followed_at,
+            )
+    except peewee.IntegrityError:
+        # Followed users were scheduled for unfollowing back then.
+        LOGGER.info('InstaBot was installed already')
+        return
 
     unfollow(configuration)
 
@@ -55,12 +81,14 @@ def main():
 
     configuration = Configuration(arguments['CONFIGURATION'])
 
-    logging.config.dictConfig(configuration.logging)
+    configure_logging(configuration.logging)
 
     db = get_db(configuration)
 
     if arguments['install']:
         install(configuration, db)
+    elif arguments['migrate']:
+        migrate(db)
     elif arguments['unfollow']:
         unfollow(configuration)
     else:
@@ -74,7 +102,68 @@ def run(configuration):
     stats_service = StatsService()
     loop.create_task(stats_service.run())
 
-    following_client = instagram.Client(configuration)
+    loop_monitor = LoopMonitor(configuration)
+    loop.create_task(loop_monitor.run())
+    profiler = SamplingProfiler(configuration)
+    loop.add_signal_handler(signal.SIGUSR2, profiler.toggle)
+
+    try:
+        metrics_service = MetricsService(configuration)
+    except ConfigurationError as e:
+        LOGGER.info('MetricsService wasn\'t started. {}'.format(e))
+    else:
+        loop.create_task(metrics_service.run())
+
+    if configuration.instagram_actions_per_hour:
+        try:
+            budget = Budget(configuration)
+        except ConfigurationError as e:
+            sys.exit('Can\'t set up budget: {}'.format(e))
+    else:
+        LOGGER.info('Budget wasn\'t set up. Actions per hour weren\'t '
+                    'specified.')
+        budget = None
+
+    try:
+        scheduler = Scheduler(configuration, budget=budget)
+    except ConfigurationError as e:
+        sys.exit('Can\'t set up scheduler: {}'.format(e))
+    loop.create_task(scheduler.run())
+
+    # Startup queries go through the DB thread too, so their connection is
+    # returned to the pool.
+    known_users = KnownUsers()
+    loop.run_until_complete(run_in_db(known_users.warm_up))
+
+    candidate_counters = CandidateCounters()
+    loop.run_until_complete(run_in_db(candidate_counters.reconcile))
+    loop.create_task(candidate_counters.run())
+
+    if configuration.instagram_cassette is None:
+        recorder = None
+    else:
+        recorder = CassetteRecorder(
+            configuration.instagram_cassette,
+            secrets=(
+                configuration.instagram_username,
+                configuration.instagram_password,
+                ),
+            )
+        LOGGER.info(
+            'Responses are recorded to %s',
+            configuration.instagram_cassette,
+            )
+
+    connector = instagram.create_connector(configuration)
+    following_client = instagram.Client(
+        configuration,
+        connector=connector,
+        budget=budget,
+        recorder=recorder,
+        )
+
+    archive_service = ArchiveService(following_client)
+    loop.create_task(archive_service.run())
 
     try:
         user_service = UserService(following_client, configuration)
@@ -86,7 +175,12 @@ def run(configuration):
     following_service = FollowingService(following_client, configuration)
     loop.create_task(following_service.run())
 
-    like_client = instagram.Client(configuration)
+    like_client = instagram.Client(
+        configuration,
+        connector=connector,
+        budget=budget,
+        recorder=recorder,
+        )
     try:
         media_service = MediaService(like_client, configuration)
     except ConfigurationError as e:
@@ -103,23 +197,61 @@ def unfollow(configuration):
     LOGGER.info('Scheduling unfollowing of everyone')
     client = instagram.Client(configuration)
     loop = asyncio.get_event_loop()
-    followed_users_json = loop.run_until_complete(client.get_followed(
-        User.get(instagram_id=client.id),
-        ))
     now = datetime.datetime.utcnow()
     was_followed_at = now - \
         datetime.timedelta(hours=configuration.following_hours)
-    for followed_json in followed_users_json:
+    known_users = KnownUsers()
+    known_users.warm_up()
+    followed_count = loop.run_until_complete(_save_followed(
+        client,
+        configuration.instagram_username,
+        known_users,
+        was_followed_at,
+        ))
+    LOGGER.info('{0} followed users were saved in DB'.format(followed_count))
+
+
+async def _save_followed(client, username, known_users, was_followed_at):
+    """Saves people followed by the client's user page by page.
+
+    Returns:
+        int: Number of saved users.
+
+    """
+    followed_count = 0
+    # The user itself may be archived already, so it's not taken from DB.
+    async for followed_users_json in client.iter_followed(
+            User(instagram_id=client.id, username=username),
+            ):
+        for followed_json in followed_users_json:
+            _save_followed_user(followed_json, known_users, was_followed_at)
+        followed_count += len(followed_users_json)
+    return followed_count
+
+
+def _save_followed_user(followed_json, known_users, was_followed_at):
+    user = None
+    # Unknown users are inserted without looking them up first.
+    if followed_json['id'] in known_users:
         try:
             user = User.get(instagram_id=followed_json['id'])
         except User.DoesNotExist:
-            user = User(instagram_id=followed_json['id'])
-        user.username = followed_json['username']
-        user.following_depth = 0
-        user.is_followed = True
-        if not user.was_followed_at or was_followed_at < user.was_followed_at:
-            user.was_followed_at = was_followed_at
+            # The user is followed again, so he isn't finished anymore.
+            ArchivedUser \
+                .delete() \
+                .where(ArchivedUser.instagram_id == followed_json['id']) \
+                .execute()
+    if user is None:
+        user = User(instagram_id=followed_json['id'])
+    user.username = followed_json['username']
+    user.following_depth = 0
+    user.state = User.FOLLOWED
+    if not user.was_followed_at or was_followed_at < user.was_followed_at:
+        user.was_followed_at = was_followed_at
+    try:
         user.save()
-    LOGGER.info(
-        '{0} followed users were saved in DB'.format(len(followed_users_json)),
-        )
+    except peewee.IntegrityError:
+        # User was inserted by somebody else after warming up.
+        user.id = User.get(instagram_id=user.instagram_id).id
+        user.save()
+    known_users.add(user.instagram_id)
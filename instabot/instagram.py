@@ -1,21 +1,88 @@
 import asyncio
+import functools
 import logging
 import json
+import os
 import re
+import time
 import urllib.parse
 
-from .errors import APIError, APILimitError, \
+from .cassette import get_request_key
+from .clock import Clock
+from .errors import APIError, APIJSONError, APILimitError, \
     APINotAllowedError, APINotFoundError, APIFailError
-from aiohttp import ClientSession
+from .hashtag_page import HashtagPageParser
+from .metrics import REGISTRY
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.errors import ClientResponseError
 from http import HTTPStatus
 
 BASE_URL = 'https://www.instagram.com/'
+CONNECTIONS = REGISTRY.gauge(
+    'instabot_http_connections',
+    'Connections of the shared HTTP connector by state.',
+    )
+ENDPOINT_ID_RE = re.compile(r'/\d+/')
+ERRORS = REGISTRY.counter(
+    'instabot_client_errors_total',
+    'Errors raised by AJAX requests by endpoint and error class.',
+    )
+HASHTAG_PAGE_CHUNK_SIZE = 16 * 1024
+# Longer tail of the page isn't worth reading to reuse the connection.
+HASHTAG_PAGE_DISCARD_LIMIT = 256 * 1024
 LOGGER = logging.getLogger('instabot.instagram')
+REQUEST_DURATION = REGISTRY.histogram(
+    'instabot_http_request_duration_seconds',
+    'Time spent on the wire by endpoint.',
+    )
+RESPONSES = REGISTRY.counter(
+    'instabot_http_responses_total',
+    'HTTP responses by endpoint and status code.',
+    )
+SLEEP_DURATION = REGISTRY.counter(
+    'instabot_client_sleep_seconds_total',
+    'Time spent in sleeps after requests by reason.',
+    )
 USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:54.0) Gecko/20100101 Firefox/54.0'
 
 
 class Client:
-    def __init__(self, configuration):
+    """Instagram client.
+
+    Args:
+        configuration (Configuration)
+        clock (Clock, optional)
+        connector (aiohttp.BaseConnector, optional): Connector to share with
+            other clients. Every client keeps its own cookies anyway. The
+            client creates its own connector by default.
+        budget (Budget, optional): Budget to share with other clients. Actions
+            are issued as soon as the budget allows instead of sleeping after
+            every successful request. By default the client sleeps and
+            issues follows, likes and unfollows one at a time, even when they
+            come from concurrent services.
+        recorder (CassetteRecorder, optional): Where to record responses.
+        session_factory (callable, optional): Creates objects to use
+            instead of `aiohttp.ClientSession`, e.g. `ReplaySession`.
+
+    """
+
+    def __init__(
+            self,
+            configuration,
+            clock=None,
+            connector=None,
+            budget=None,
+            recorder=None,
+            session_factory=None,
+            ):
+        self._clock = Clock() if clock is None else clock
+        self._connector = connector
+        self._budget = budget
+        # Without the budget actions are paced by sleeps after them, so
+        # concurrent services shouldn't issue them at once.
+        self._actions_lock = asyncio.Lock()
+        self._recorder = recorder
+        self._session_factory = session_factory
         self._limit_sleep_time_coefficient = configuration \
             .instagram_limit_sleep_time_coefficient
         self._limit_sleep_time_min = configuration \
@@ -31,24 +98,52 @@ class Client:
         self._username = configuration.instagram_username
         self._password = configuration.instagram_password
         self._referer = BASE_URL
-        self._session = ClientSession(
-            cookies={
-                'ig_pr': '1',
-                'ig_vw': '1920',
-                },
-            headers={
-                'User-Agent': USER_AGENT,
-                'X-Instagram-AJAX': '1',
-                'X-Requested-With': 'XMLHttpRequest',
-                },
-            )
+        self._session_file = configuration.instagram_session_file
+        self._session = self._create_session()
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._do_login())
+        loop.run_until_complete(self._login())
+
+    async def _ajax(self, url, data=None, referer=None, action=None):
+        """Simulates AJAX request and counts its errors.
+
+        Args:
+            url (str): URL path. e.g.: 'query/'
+            data (dict, optional)
+            referer (str, optional): Last visited URL.
+            action (str, optional): Budget to spend on the request. The
+                request isn't limited by default.
+
+        Raises:
+            APIError
+            APIFailError
+            APIJSONError
+            APILimitError
+            APINotAllowedError
+            APINotFoundError
 
-    async def _ajax(self, url, data=None, referer=None):
+        """
+        endpoint = ENDPOINT_ID_RE.sub('/{id}/', url)
+        if action is not None and self._budget is not None:
+            await self._budget.acquire(action)
+        try:
+            if self._budget is None and action not in (None, 'query'):
+                async with self._actions_lock:
+                    return await self._send_ajax(
+                        endpoint,
+                        url,
+                        data,
+                        referer,
+                        )
+            return await self._send_ajax(endpoint, url, data, referer)
+        except Exception as err:
+            ERRORS.increment(endpoint=endpoint, error=type(err).__name__)
+            raise
+
+    async def _send_ajax(self, endpoint, url, data=None, referer=None):
         """Simulates AJAX request.
 
         Args:
+            endpoint (str): URL path without IDs to measure request for.
             url (str): URL path. e.g.: 'query/'
             data (dict, optional)
             referer (str, optional): Last visited URL.
@@ -69,6 +164,7 @@ class Client:
             'Referer': self._referer,
             'X-CSRFToken': self._csrf_token,
             }
+        started = time.perf_counter()
         async with self._session.post(
             url,
             data=data,
@@ -76,13 +172,19 @@ class Client:
             ) as response:
             if response.status == HTTPStatus.NOT_FOUND:
                 response.close()
+                _observe_response(endpoint, response.status, started)
+                self._record('POST', url, data, response, '')
                 await self._sleep_success()
                 raise APINotFoundError(f'AJAX response status code is 404 for {url}')
             elif HTTPStatus.INTERNAL_SERVER_ERROR <= response.status:
                 response.close()
+                _observe_response(endpoint, response.status, started)
+                self._record('POST', url, data, response, '')
                 await self._sleep_success()
                 raise APIError(response.status)
             text = await response.text()
+            _observe_response(endpoint, response.status, started)
+            self._record('POST', url, data, response, text)
             try:
                 response_dict = json.loads(text)
             except ValueError as err:
@@ -105,10 +207,111 @@ class Client:
             raise APIFailError(f'AJAX request to {url} was failed: {response_dict}')
         elif status != 'ok':
             raise APIError(f'AJAX request to {url} is not OK: {response_dict}')
-        LOGGER.debug(f'Request: {url} Response: {response_dict}')
+        LOGGER.debug('Request: %s Response: %s', url, response_dict)
         await self._sleep_success()
         return response_dict
 
+    def _create_session(self):
+        if self._session_factory is not None:
+            return self._session_factory()
+        return ClientSession(
+            connector=self._connector,
+            cookies={
+                'ig_pr': '1',
+                'ig_vw': '1920',
+                },
+            headers={
+                'User-Agent': USER_AGENT,
+                'X-Instagram-AJAX': '1',
+                'X-Requested-With': 'XMLHttpRequest',
+                },
+            )
+
+    async def _login(self):
+        """Restores saved session or logins from scratch.
+
+        Raises:
+            APIJSONError
+            APILimitError
+            APINotAllowedError
+            APIError
+
+        """
+        if await self._restore_session():
+            LOGGER.debug('Saved session was restored')
+            return
+        await self._do_login()
+        self._save_session()
+
+    async def _restore_session(self):
+        """Loads cookies and CSRF token from the session file and checks them
+        with a cheap query.
+
+        Returns:
+            bool: True if the saved session is still valid.
+
+        """
+        if self._session_file is None:
+            return False
+        try:
+            with open(self._session_file, 'r') as f:
+                saved_session = json.load(f)
+            cookies = saved_session['cookies']
+            csrf_token = saved_session['csrf_token']
+            user_id = cookies['ds_user_id']
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            LOGGER.warning('Can\'t load saved session: %s', e)
+            return False
+        self._session.cookies.load(cookies)
+        self._csrf_token = csrf_token
+        try:
+            await self._ajax(
+                'query/',
+                {'q': 'ig_user({}) {{ id }}'.format(user_id)},
+                )
+        except (APIError, APIJSONError, APILimitError, APINotAllowedError,
+                APINotFoundError, ClientResponseError, OSError) as e:
+            # Fresh login is the fallback whatever was wrong.
+            LOGGER.info('Saved session is invalid: %s', e)
+            self._reset_session()
+            return False
+        self.id = user_id
+        return True
+
+    def _save_session(self):
+        if self._session_file is None:
+            return
+        saved_session = {
+            'cookies': {
+                name: morsel.value
+                for name, morsel in self._session.cookies.items()
+                },
+            'csrf_token': self._csrf_token,
+            }
+        temporary_filename = '{}.tmp'.format(self._session_file)
+        try:
+            # The file contains credentials, so it's readable by owner only.
+            descriptor = os.open(
+                temporary_filename,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                0o600,
+                )
+            with open(descriptor, 'w') as f:
+                json.dump(saved_session, f)
+            os.replace(temporary_filename, self._session_file)
+        except OSError as e:
+            LOGGER.warning('Can\'t save session: %s', e)
+
+    def _reset_session(self):
+        if self._connector is None:
+            self._session.close()
+        else:
+            # Shared connector should stay open for other clients.
+            self._session.detach()
+        self._session = self._create_session()
+
     async def _do_login(self):
         """Logins client session.
 
@@ -148,6 +351,7 @@ class Client:
             await self._ajax(
                 'web/friendships/{}/follow/'.format(user.instagram_id),
                 referer=user.get_url(),
+                action='follow',
                 )
         except APILimitError as e:
             raise APILimitError(
@@ -160,20 +364,19 @@ class Client:
                 .format(user.username, e),
                 )
         else:
-            LOGGER.debug('{} was followed'.format(user.username))
+            LOGGER.debug('%s was followed', user.username)
 
-    async def get_followed(self, user):
-        """Fetches information about people followed by given user.
+    async def _get_followed_page(self, user, cursor=None):
+        """Fetches one page of people followed by given user.
 
         Args:
             user (User): Whose subscriptions should be fetched.
+            cursor (str, optional): The page to retrieve. The first one by
+                default.
 
         Returns:
-            List of dicts containing following fields:
-            {
-                'id': '123',
-                'username': 'foobar',
-            }
+            (list, str, bool): Followed users, end cursor and whether there
+            is the next page.
 
         Raises:
             APIJSONError
@@ -183,11 +386,12 @@ class Client:
 
         """
         single_response_size = 50
-
+        cursor = 'first({})'.format(single_response_size) if cursor is None \
+            else 'after({}, {})'.format(cursor, single_response_size)
         response = await self._ajax(
             'query/',
             {
-                'q': 'ig_user({id}) {{  follows.first({count}) {{    count,'
+                'q': 'ig_user({id}) {{  follows.{cursor} {{    count,'
                 '    page_info {{      end_cursor,      has_next_page    }},'
                 '    nodes {{      id,      is_verified,'
                 '      followed_by_viewer,      requested_by_viewer,'
@@ -195,36 +399,28 @@ class Client:
                 '      username    }}  }}}}'
                 .format(
                     id=user.instagram_id,
-                    count=single_response_size,
+                    cursor=cursor,
                     ),
                 'ref': 'relationships::follow_list',
                 },
             referer=user.get_url(),
+            action='query',
             )
-        followed = response['follows']['nodes']
-        while response['follows']['page_info']['has_next_page']:
-            end_cursor = response['follows']['page_info']['end_cursor']
-            response = await self._ajax(
-                'query/',
-                {
-                    'q': 'ig_user({id}) {{  follows.after({end_cursor},'
-                    ' {count}) {{    count,    page_info {{      end_cursor,'
-                    '      has_next_page    }},    nodes {{      id,'
-                    '      is_verified,      followed_by_viewer,'
-                    '      requested_by_viewer,      full_name,'
-                    '      profile_pic_url,      username    }}  }}}}'
-                    .format(
-                        id=user.instagram_id,
-                        end_cursor=end_cursor,
-                        count=single_response_size,
-                        ),
-                    'ref': 'relationships::follow_list',
-                    },
-                referer=user.get_url(),
+        try:
+            followed = response['follows']['nodes']
+            page_info = response['follows']['page_info']
+            end_cursor = page_info['end_cursor']
+            has_next_page = page_info['has_next_page']
+        except (KeyError, TypeError) as e:
+            raise APINotAllowedError(
+                'Instagram have given unexpected data in '
+                '`_get_followed_page`. Response JSON: {response} '
+                'Error: {error}'.format(
+                    response=response,
+                    error=e,
                 )
-            followed.extend(response['follows']['nodes'])
-        LOGGER.debug('{} followed users were fetched'.format(len(followed)))
-        return followed
+            )
+        return followed, end_cursor, has_next_page
 
     async def _get_followers_page(self, user, cursor=None):
         """
@@ -260,7 +456,12 @@ class Client:
         }}''' \
             .format(user_instagram_id=user.instagram_id, cursor=cursor)
         data = {'q': query, 'ref': 'relationships::follow_list'}
-        response = await self._ajax('query/', data, referer=user.get_url())
+        response = await self._ajax(
+            'query/',
+            data,
+            referer=user.get_url(),
+            action='query',
+            )
         try:
             followers = response['followed_by']['nodes']
             page_info = response['followed_by']['page_info']
@@ -297,45 +498,77 @@ class Client:
             BASE_URL,
             urllib.parse.quote(hashtag.encode('utf-8')),
             )
+        if self._budget is not None:
+            await self._budget.acquire('query')
+        started = time.perf_counter()
         response = await self._session.get(url)
-        response = await response.read()
-        response = response.decode('utf-8', errors='ignore')
-        match = re.search(
-            r'<script type="text/javascript">[\w\.]+\s*=\s*([^<]+);'
-            '</script>',
-            response,
-            )
-        if match is None:
-            raise APIError('Can\'t find JSON in the response: {}', response)
-        try:
-            response = json.loads(match.group(1))
-        except ValueError as e:
-            raise APIError('Can\'t parse response JSON: {}'.format(e))
+        parser = HashtagPageParser()
+        # Read part of the page if it's recorded.
+        chunks = None if self._recorder is None else []
         try:
-            tag = response['entry_data']['TagPage'][0]['graphql']['hashtag']
-            edges = tag['edge_hashtag_to_media']['edges']
-            media = [edge['node']['id'] for edge in edges]
-        except (KeyError, TypeError) as e:
-            raise APIError(
-                'Can\'t obtain media from response JSON: {}'.format(e),
+            while True:
+                chunk = await response.content.read(HASHTAG_PAGE_CHUNK_SIZE)
+                if not chunk:
+                    await response.release()
+                    break
+                if chunks is not None:
+                    chunks.append(chunk)
+                if parser.feed(chunk):
+                    # The rest of the page isn't needed.
+                    await _discard_rest(response)
+                    break
+        finally:
+            # Drops the connection if the page wasn't read till the end.
+            response.close()
+        _observe_response('explore/tags/{tag}/', response.status, started)
+        if chunks is not None:
+            self._record(
+                'GET',
+                url,
+                None,
+                response,
+                b''.join(chunks).decode('utf-8', errors='ignore'),
                 )
-        LOGGER.debug(
-            '{} media about \"{}\" were fetched'.format(len(media), hashtag),
-            )
+        media = parser.get_media()
+        LOGGER.debug('%d media about "%s" were fetched', len(media), hashtag)
         return media
 
-    async def get_some_followers(self, user):
-        """Fetches some amount of followers of given user.
+    async def iter_followed(self, user):
+        """Asynchronously iterates over pages of people followed by given
+        user.
+
+        Args:
+            user (User): Whose subscriptions should be fetched.
+
+        Yields:
+            list: Dicts with `id` and `username` of followed users and
+            their relationship with the client's user.
+
+        Raises:
+            APIJSONError
+            APILimitError
+            APINotAllowedError
+            APIError
+
+        """
+        cursor = None
+        has_next_page = True
+        while has_next_page:
+            followed, cursor, has_next_page = \
+                await self._get_followed_page(user, cursor)
+            yield followed
+
+    async def iter_followers(self, user, cursor=None):
+        """Asynchronously iterates over pages of followers of given user.
 
         Args:
             user (User): Whose followers should be fetched.
+            cursor (str, optional): End cursor of the last fetched page to
+                continue from.
 
-        Returns:
-            List of dicts containing following fields:
-            {
-                'id': '123',
-                'username': 'foobar',
-            }
+        Yields:
+            (list, str, bool): Followers, end cursor of the page and whether
+            there is the next page.
 
         Raises:
             APIJSONError
@@ -344,24 +577,13 @@ class Client:
             APIError
 
         """
-        pages_to_fetch = 3
-        followers = []
-        get_next = True
-        cursor = None  # Eventually we will check if we have a
-        # cached page and use that.
-        LOGGER.debug('Fetching followers of {}'.format(user.username))
-        while get_next and pages_to_fetch > 0:
-            next_followers, cursor, get_next = await self._get_followers_page(
-                user=user,
-                cursor=cursor,
-                )
-            followers.extend(next_followers)
-            pages_to_fetch -= 1
-            await asyncio.sleep(5)
-        # TODO: Cache cursor for continuation of this, if needed.
-        LOGGER.debug('Fetched {} followers of {}'
-                     .format(len(followers), user.username))
-        return followers
+        has_next_page = True
+        while has_next_page:
+            followers, cursor, has_next_page = \
+                await self._get_followers_page(user, cursor)
+            yield followers, cursor, has_next_page
+            if has_next_page and self._budget is None:
+                await self._clock.sleep(5)
 
     async def like(self, media):
         """
@@ -372,13 +594,16 @@ class Client:
         @raise APINotFoundError
         """
         try:
-            await self._ajax('web/likes/{}/like/'.format(media))
+            await self._ajax(
+                'web/likes/{}/like/'.format(media),
+                action='like',
+                )
         except APILimitError as e:
             raise APILimitError(
                 'API limit was reached during liking {}. {}'.format(media, e),
                 )
         else:
-            LOGGER.debug('Liked {}'.format(media))
+            LOGGER.debug('Liked %s', media)
 
     async def _open(self, url):
         """Opens given URL (HTTP GET).
@@ -393,29 +618,51 @@ class Client:
         headers = {
             'Referer': self._referer,
             }
+        started = time.perf_counter()
         response = await self._session.get(url, headers=headers)
         self._referer = url
-        response = await response.text()
-        return response
+        status = response.status
+        text = await response.text()
+        self._record('GET', url, None, response, text)
+        _observe_response(
+            ENDPOINT_ID_RE.sub('/{id}/', urllib.parse.urlsplit(url).path[1:]),
+            status,
+            started,
+            )
+        return text
+
+    def _record(self, method, url, data, response, body):
+        if self._recorder is not None:
+            self._recorder.record(
+                get_request_key(method, url, data),
+                response.status,
+                response.cookies.keys(),
+                body,
+                )
 
     async def relogin(self):
-        await self._session.close()
-        self._session.cookies.clear()
+        self._reset_session()
         await self._do_login()
+        self._save_session()
 
     async def _sleep_limit(self):
         LOGGER.debug(
-            'Sleeping for {:.0f} sec because of API limits'
-            .format(self._limit_sleep_time),
+            'Sleeping for %.0f sec because of API limits',
+            self._limit_sleep_time,
             )
-        await asyncio.sleep(self._limit_sleep_time)
+        SLEEP_DURATION.increment(self._limit_sleep_time, reason='limit')
+        await self._clock.sleep(self._limit_sleep_time)
         self._limit_sleep_time *= self._limit_sleep_time_coefficient
 
     async def _sleep_success(self):
         if self._limit_sleep_time != self._limit_sleep_time_min:
             self._limit_sleep_time = self._limit_sleep_time_min
             self._success_sleep_time = self._success_sleep_time_max
-        await asyncio.sleep(self._success_sleep_time)
+        if self._budget is not None:
+            # The budget paces requests itself.
+            return
+        SLEEP_DURATION.increment(self._success_sleep_time, reason='success')
+        await self._clock.sleep(self._success_sleep_time)
         self._success_sleep_time = self._success_sleep_time_min + \
             (self._success_sleep_time - self._success_sleep_time_min) * \
             self._success_sleep_time_coefficient
@@ -436,6 +683,7 @@ class Client:
             await self._ajax(
                 'web/friendships/{}/unfollow/'.format(user.instagram_id),
                 referer=user.get_url(),
+                action='unfollow',
                 )
         except APILimitError as e:
             raise APILimitError(
@@ -453,8 +701,57 @@ class Client:
                 .format(user.username, e),
                 )
         else:
-            LOGGER.debug('{} was unfollowed'.format(user.username))
+            LOGGER.debug('%s was unfollowed', user.username)
 
     def _update_csrf_token(self):
         self._csrf_token = self._session.cookies['csrftoken'].value
         LOGGER.debug('CSRF token is %s', self._csrf_token)
+
+
+async def _discard_rest(response):
+    """Reads the rest of the response and releases its connection to be
+    reused. Gives up if the rest is longer than `HASHTAG_PAGE_DISCARD_LIMIT`.
+
+    """
+    discarded_size = 0
+    while discarded_size <= HASHTAG_PAGE_DISCARD_LIMIT:
+        chunk = await response.content.read(HASHTAG_PAGE_CHUNK_SIZE)
+        if not chunk:
+            await response.release()
+            return
+        discarded_size += len(chunk)
+
+
+def _observe_response(endpoint, status, started):
+    REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
+    RESPONSES.increment(endpoint=endpoint, status=status)
+
+
+def create_connector(configuration):
+    """Creates HTTP connector to share between clients.
+
+    The connector keeps connections alive, caches DNS and limits connections
+    to the same host.
+
+    """
+    connector = TCPConnector(
+        keepalive_timeout=configuration.instagram_keepalive_timeout,
+        limit=configuration.instagram_connections_limit,
+        use_dns_cache=True,
+        )
+    REGISTRY.add_collector(functools.partial(
+        _collect_connector_stats,
+        connector,
+        ))
+    return connector
+
+
+def _collect_connector_stats(connector):
+    CONNECTIONS.set(
+        sum(len(conns) for conns in connector._conns.values()),
+        state='idle',
+        )
+    CONNECTIONS.set(
+        sum(len(conns) for conns in connector._acquired.values()),
+        state='in_use',
+        )
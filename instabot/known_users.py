@@ -0,0 +1,79 @@
+import array
+import bisect
+import heapq
+import logging
+from .archived_user import ArchivedUser
+from .user import User
+
+LOGGER = logging.getLogger('instabot.known_users')
+MERGE_THRESHOLD = 10000
+
+
+class KnownUsers:
+    """In-memory set of Instagram IDs of users saved in DB, archived ones
+    included.
+
+    IDs are kept in a sorted array of unsigned 64-bit integers (8 bytes per
+    user) plus a small set of recently added IDs which is merged into the
+    array from time to time.
+
+    The set can miss users inserted by another process, so callers should
+    still be ready to get `IntegrityError` for "unknown" users.
+
+    """
+    _instance = None
+
+    def __init__(self):
+        self._ids = array.array('Q')
+        self._added = set()
+        type(self)._instance = self
+
+    def __contains__(self, instagram_id):
+        try:
+            instagram_id = int(instagram_id)
+        except (TypeError, ValueError):
+            return False
+        if instagram_id in self._added:
+            return True
+        i = bisect.bisect_left(self._ids, instagram_id)
+        return i != len(self._ids) and self._ids[i] == instagram_id
+
+    def __len__(self):
+        return len(self._ids) + len(self._added)
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    def add(self, instagram_id):
+        try:
+            instagram_id = int(instagram_id)
+        except (TypeError, ValueError):
+            return
+        if instagram_id in self:
+            return
+        self._added.add(instagram_id)
+        if len(self._added) >= MERGE_THRESHOLD:
+            self._merge()
+
+    def warm_up(self):
+        """Loads IDs of all users from DB."""
+        ids = []
+        for model in (User, ArchivedUser):
+            ids.extend(
+                instagram_id for (instagram_id,) in model
+                .select(model.instagram_id)
+                .tuples()
+                .iterator()
+                )
+        ids.sort()
+        self._ids = array.array('Q', ids)
+        self._added.clear()
+        LOGGER.debug('%d known users were loaded', len(self._ids))
+
+    def _merge(self):
+        self._ids = array.array(
+            'Q',
+            heapq.merge(self._ids, sorted(self._added)),
+            )
+        self._added.clear()
@@ -1,7 +1,8 @@
-import asyncio
 import logging
+from .clock import Clock
 from .errors import APIError, APIJSONError, APILimitError, \
     APINotAllowedError, APINotFoundError
+from .scheduler import Scheduler
 from .stats_service import StatsService
 from aiohttp.errors import ClientResponseError
 
@@ -9,27 +10,29 @@ LOGGER = logging.getLogger('instabot.like_service')
 
 
 class LikeService:
-    def __init__(self, client, media_service):
+    def __init__(self, client, media_service, clock=None):
         self._client = client
+        self._clock = Clock() if clock is None else clock
         self._media_service = media_service
+        self._scheduler = Scheduler.get_instance()
         self._stats_service = StatsService.get_instance()
 
     async def run(self):
         media = await self._media_service.pop()
         while True:
             try:
-                await self._client.like(media)
+                await self._scheduler.submit('like', self._client.like, media)
             except APILimitError as e:
                 LOGGER.debug(e)
             except (APIError, APIJSONError) as e:
                 LOGGER.debug(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
             except (APINotAllowedError, APINotFoundError) as e:
-                LOGGER.debug('Can\'t like {}. {}'.format(media, str(e)))
+                LOGGER.debug('Can\'t like %s. %s', media, e)
                 media = await self._media_service.pop()
             except (IOError, OSError, ClientResponseError) as e:
                 LOGGER.warning(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
             else:
                 media = await self._media_service.pop()
                 self._stats_service.increment('liked')
@@ -0,0 +1,142 @@
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import random
+import time
+from .metrics import REGISTRY
+
+# How often, in seconds, refilled rate limit buckets are forgotten.
+BUCKETS_SWEEP_INTERVAL = 60
+
+DROPPED_RECORDS = REGISTRY.counter(
+    'instabot_log_records_dropped_total',
+    'Log records dropped by sampling and rate limits by logger.',
+    )
+
+
+class SamplingFilter(logging.Filter):
+    """Passes given share of records below WARNING level.
+
+    Args:
+        rate (float): Share of records to pass, from 0 to 1.
+
+    """
+
+    def __init__(self, rate):
+        super(SamplingFilter, self).__init__()
+        self._rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or random.random() < self._rate:
+            return True
+        DROPPED_RECORDS.increment(logger=record.name)
+        return False
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most given number of records per minute from the same
+    logging call. Records of WARNING level and above always pass.
+
+    Args:
+        per_minute (float)
+
+    """
+
+    def __init__(self, per_minute):
+        super(RateLimitFilter, self).__init__()
+        self._rate = per_minute / 60
+        self._capacity = max(1, per_minute)
+        # (logger, path, line) -> (tokens, monotonic time of update).
+        self._buckets = {}
+        self._swept_at = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        if now - self._swept_at >= BUCKETS_SWEEP_INTERVAL:
+            self._sweep(now)
+        # Messages are often formatted by callers or are exceptions, so
+        # records are told apart by the call site instead.
+        key = record.name, record.pathname, record.lineno
+        tokens, updated = self._buckets.get(key, (self._capacity, now))
+        tokens = min(self._capacity, tokens + (now - updated) * self._rate)
+        if tokens < 1:
+            self._buckets[key] = tokens, now
+            DROPPED_RECORDS.increment(logger=record.name)
+            return False
+        self._buckets[key] = tokens - 1, now
+        return True
+
+    def _sweep(self, now):
+        """Forgets buckets which have refilled, they're the same as new."""
+        if self._rate > 0:
+            refilled_before = now - self._capacity / self._rate
+            self._buckets = {
+                key: bucket
+                for key, bucket in self._buckets.items()
+                if bucket[1] > refilled_before
+                }
+        self._swept_at = now
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Puts records to the queue as they are.
+
+    Unlike `QueueHandler`, doesn't format records before enqueuing, so
+    messages are formatted by the listener thread.
+
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(configuration):
+    """Configures logging with `logging.config.dictConfig`.
+
+    Handlers of every configured logger are moved to a background thread
+    which formats and writes records taken from a queue, so the event loop
+    doesn't wait for I/O.
+
+    Besides the standard keys, the configuration may contain:
+
+    * `queue` — set to `false` to keep handlers in the logging thread.
+    * `sampling` — logger name -> share of its records to pass.
+    * `rate_limits` — logger name -> records from the same logging call
+      to pass per minute.
+
+    Args:
+        configuration (dict): `logging` section of the configuration.
+
+    """
+    configuration = dict(configuration)
+    use_queue = configuration.pop('queue', True)
+    sampling = configuration.pop('sampling', {})
+    rate_limits = configuration.pop('rate_limits', {})
+    logging.config.dictConfig(configuration)
+    for name, rate in sampling.items():
+        logging.getLogger(name).addFilter(SamplingFilter(float(rate)))
+    for name, per_minute in rate_limits.items():
+        logging.getLogger(name).addFilter(RateLimitFilter(float(per_minute)))
+    if not use_queue:
+        return
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+        ]
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        records = queue.Queue()
+        listener = logging.handlers.QueueListener(
+            records,
+            *logger.handlers,
+            respect_handler_level=True
+            )
+        logger.handlers = [LazyQueueHandler(records)]
+        listener.start()
+        atexit.register(listener.stop)
@@ -1,38 +1,67 @@
 import asyncio
+import collections
 import itertools
 import logging
+from .clock import Clock
 from .errors import APIError, ConfigurationError
+from .scheduler import Scheduler
 from aiohttp.errors import ClientResponseError
 
 LOGGER = logging.getLogger('instabot.media_service')
 MEDIA_COUNT_MIN = 100
+RECENT_MEDIA_COUNT = 10000
 
 
 class MediaService:
-    def __init__(self, client, configuration):
+    def __init__(self, client, configuration, clock=None):
         self._hashtags = configuration.hashtags
         if len(self._hashtags) == 0:
             raise ConfigurationError('No hashtags were specified')
-        self._media = []
+        self._media = asyncio.Queue(maxsize=MEDIA_COUNT_MIN)
+        # LRU of recently queued media IDs to not like the same media found
+        # by different hashtags twice.
+        self._recent_media = collections.OrderedDict()
         self._client = client
+        self._clock = Clock() if clock is None else clock
+        self._scheduler = Scheduler.get_instance()
 
     async def run(self):
         for hashtag in itertools.cycle(self._hashtags):
             try:
-                media = await self._client.get_media_by_hashtag(hashtag)
+                media = await self._scheduler.submit(
+                    'crawl',
+                    self._client.get_media_by_hashtag,
+                    hashtag,
+                    )
             except (APIError, ClientResponseError, IOError, OSError) as e:
                 LOGGER.warning(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
             else:
-                self._media.extend(media)
-                await asyncio.sleep(3)
-            while len(self._media) >= MEDIA_COUNT_MIN:
-                await asyncio.sleep(30)
+                for media_id in media:
+                    if self._remember(media_id):
+                        # Blocks until there's free space in the queue.
+                        await self._media.put(media_id)
+                await self._clock.sleep(3)
+
+    def __len__(self):
+        return self._media.qsize()
 
     async def pop(self):
-        while True:
-            try:
-                return self._media.pop(0)
-            except IndexError:
-                LOGGER.debug('Has no media to pop')
-                await asyncio.sleep(5)
+        if self._media.empty():
+            LOGGER.debug('Has no media to pop')
+        return await self._media.get()
+
+    def _remember(self, media_id):
+        """Marks media as queued.
+
+        Returns:
+            bool: False if the media was queued recently.
+
+        """
+        if media_id in self._recent_media:
+            self._recent_media.move_to_end(media_id)
+            return False
+        self._recent_media[media_id] = None
+        if len(self._recent_media) > RECENT_MEDIA_COUNT:
+            self._recent_media.popitem(last=False)
+        return True
@@ -0,0 +1,187 @@
+import asyncio
+import bisect
+import logging
+from .errors import ConfigurationError
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+    )
+LOGGER = logging.getLogger('instabot.metrics')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace('\\', '\\\\')
+            .replace('\n', '\\n')
+            .replace('"', '\\"'),
+            )
+        for name, value in labels
+        ))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self._documentation = documentation
+        self._values = {}
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self._documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+            ]
+        for labels, value in sorted(self._values.items()):
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return ['{}{} {}'.format(
+            self.name,
+            _format_labels(labels),
+            _format_value(value),
+            )]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def increment(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        try:
+            counts, total = self._values[key]
+        except KeyError:
+            counts, total = [0] * (len(self._buckets) + 1), 0
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._values[key] = counts, total + value
+
+    def _render_value(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative_count = 0
+        for bound, count in zip(self._buckets + (float('inf'),), counts):
+            cumulative_count += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(labels, (('le', _format_value(bound)),)),
+                cumulative_count,
+                ))
+        lines.append('{}_sum{} {}'.format(
+            self.name,
+            _format_labels(labels),
+            _format_value(total),
+            ))
+        lines.append('{}_count{} {}'.format(
+            self.name,
+            _format_labels(labels),
+            cumulative_count,
+            ))
+        return lines
+
+
+class Registry:
+    """Keeps metrics and renders them in Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def add_collector(self, collector):
+        """Registers a function to call before every rendering.
+
+        Useful for gauges which are cheaper to compute on demand.
+
+        """
+        self._collectors.append(collector)
+
+    def counter(self, name, documentation):
+        return self._get_or_create(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._get_or_create(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, buckets)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                LOGGER.exception('Metrics collector has failed')
+        lines = []
+        for _, metric in sorted(self._metrics.items()):
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _get_or_create(self, metric_class, name, *args):
+        try:
+            return self._metrics[name]
+        except KeyError:
+            metric = self._metrics[name] = metric_class(name, *args)
+            return metric
+
+
+REGISTRY = Registry()
+
+
+class MetricsService:
+    """Serves metrics from `REGISTRY` over HTTP."""
+
+    def __init__(self, configuration):
+        if configuration.metrics_port is None:
+            raise ConfigurationError('Metrics port wasn\'t specified')
+        self._host = configuration.metrics_host
+        self._port = configuration.metrics_port
+
+    async def _metrics(self, request):
+        return web.Response(
+            body=REGISTRY.render().encode('utf-8'),
+            headers={'Content-Type': CONTENT_TYPE},
+            )
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        app = web.Application(loop=loop)
+        app.router.add_route('GET', '/metrics', self._metrics)
+        await loop.create_server(app.make_handler(), self._host, self._port)
+        LOGGER.info(
+            'Serving metrics on http://%s:%d/metrics',
+            self._host,
+            self._port,
+            )
@@ -0,0 +1,218 @@
+import datetime
+import logging
+from .archived_user import ArchivedUser
+from .followers_cursor import FollowersCursor
+from .user import database_proxy, User
+from peewee import *
+from playhouse.migrate import MySQLMigrator, migrate as migrate_schema
+from playhouse.shortcuts import case
+
+BATCH_SIZE = 10000
+# Index added last by `_add_profile_stats`, it marks its completion.
+FOLLOW_BACK_INDEX = ['state', 'follow_back_rank', 'created']
+LOGGER = logging.getLogger('instabot.migration')
+
+
+class LegacyUser(Model):
+    """`User` table before states were packed and IDs became integers."""
+    created = DateTimeField(default=datetime.datetime.utcnow)
+    following_depth = IntegerField()
+    instagram_id = CharField(max_length=20, unique=True)
+    is_followed = BooleanField(default=False)
+    username = CharField(max_length=30)
+    was_followed_at = DateTimeField(null=True)
+    were_followers_fetched = BooleanField(default=False)
+
+    class Meta:
+        database = database_proxy
+        db_table = 'user'
+
+
+class MigratedUser(User):
+    """Compact `User` table being filled in before it replaces the legacy
+    one."""
+
+    class Meta:
+        db_table = 'user_new'
+
+
+def migrate(db):
+    """Converts legacy `User` table to the compact schema.
+
+    Rows are copied into a new table in batches, each batch in its own short
+    transaction, so the legacy table isn't locked for long and the previous
+    version of the bot may keep working meanwhile. The migration may be
+    interrupted and started again, it continues from the last copied batch.
+    Users inserted during the copy are copied by a catch-up pass right
+    before the tables are swapped with a single atomic `RENAME TABLE`. The
+    legacy table is kept as `user_old`. Follows and unfollows of already
+    copied users made during the copy aren't carried over, the new version
+    of the bot follows or unfollows such users once more. Tables which were
+    converted by earlier versions get columns of profile stats, which are
+    filled in by batches too. Tables added since the first version are
+    created.
+
+    Args:
+        db (Database)
+
+    """
+    columns = {column.name for column in db.get_columns('user')}
+    if 'state' not in columns:
+        db.create_tables([MigratedUser], safe=True)
+        _copy_users()
+        LOGGER.info('Copying users inserted during the copy')
+        _copy_users()
+        db.execute_sql(
+            'RENAME TABLE `user` TO `user_old`, `user_new` TO `user`',
+            )
+    elif FOLLOW_BACK_INDEX not in [
+            index.columns for index in db.get_indexes('user')
+            ]:
+        _add_profile_stats(db, columns)
+    else:
+        LOGGER.info('User table is migrated already')
+    db.create_tables([FollowersCursor, ArchivedUser], safe=True)
+    foreign_key = _get_foreign_key(db, 'followerscursor', 'user_id')
+    if foreign_key is not None and foreign_key[1] != 'user':
+        constraint, _ = foreign_key
+        # Foreign key has followed the legacy table during renaming.
+        db.execute_sql(
+            'ALTER TABLE `followerscursor` DROP FOREIGN KEY `{}`'
+            .format(constraint),
+            )
+        db.execute_sql(
+            'ALTER TABLE `followerscursor` ADD FOREIGN KEY (`user_id`) '
+            'REFERENCES `user` (`id`) ON DELETE CASCADE',
+            )
+    LOGGER.info(
+        'User table was migrated. Drop `user_old` table when you make sure '
+        'that everything works',
+        )
+
+
+def _add_profile_stats(db, columns):
+    """Adds columns of profile stats to `User` table.
+
+    The columns are added as nullable, so MySQL doesn't rewrite every row
+    under a lock, and are filled in with defaults by batches afterwards.
+    Users inserted by the previous version meanwhile are filled in by a
+    catch-up pass. The index is added last.
+
+    Args:
+        db (Database)
+        columns (set): Names of columns `User` table has already.
+
+    """
+    LOGGER.info('Adding profile stats to User table')
+    migrator = MySQLMigrator(db)
+    fields = {
+        'follow_back_rank': SmallIntegerField(null=True),
+        'followers_count': IntegerField(null=True),
+        'follows_count': IntegerField(null=True),
+        'follows_viewer': BooleanField(null=True),
+        'is_verified': BooleanField(null=True),
+        }
+    operations = [
+        migrator.add_column('user', name, field)
+        for name, field in sorted(fields.items())
+        if name not in columns
+        ]
+    if operations:
+        migrate_schema(*operations)
+    _fill_in_profile_stats()
+    LOGGER.info('Filling in profile stats of users inserted meanwhile')
+    _fill_in_profile_stats()
+    migrate_schema(migrator.add_index('user', FOLLOW_BACK_INDEX, False))
+
+
+def _copy_users():
+    last_id = MigratedUser.select(fn.MAX(MigratedUser.id)).scalar() or 0
+    max_id = LegacyUser.select(fn.MAX(LegacyUser.id)).scalar() or 0
+    state = case(None, (
+        (LegacyUser.was_followed_at >> None, User.CANDIDATE),
+        (LegacyUser.is_followed == True, User.FOLLOWED),
+        ), User.FINISHED)
+    while last_id < max_id:
+        batch_last_id = min(last_id + BATCH_SIZE, max_id)
+        query = LegacyUser \
+            .select(
+                LegacyUser.id,
+                LegacyUser.created,
+                LegacyUser.following_depth,
+                # MySQL converts numeric strings itself.
+                LegacyUser.instagram_id,
+                state,
+                LegacyUser.username,
+                LegacyUser.was_followed_at,
+                LegacyUser.were_followers_fetched,
+                Param(User.UNKNOWN_RANK),
+                Param(False),
+                Param(False),
+                ) \
+            .where(
+                (LegacyUser.id > last_id) &
+                (LegacyUser.id <= batch_last_id),
+                )
+        with MigratedUser._meta.database.atomic():
+            MigratedUser \
+                .insert_from(
+                    [
+                        MigratedUser.id,
+                        MigratedUser.created,
+                        MigratedUser.following_depth,
+                        MigratedUser.instagram_id,
+                        MigratedUser.state,
+                        MigratedUser.username,
+                        MigratedUser.was_followed_at,
+                        MigratedUser.were_followers_fetched,
+                        MigratedUser.follow_back_rank,
+                        MigratedUser.follows_viewer,
+                        MigratedUser.is_verified,
+                        ],
+                    query,
+                    ) \
+                .execute()
+        last_id = batch_last_id
+        LOGGER.info('Users till ID %d of %d were copied', last_id, max_id)
+
+
+def _fill_in_profile_stats():
+    last_id = 0
+    max_id = User.select(fn.MAX(User.id)).scalar() or 0
+    while last_id < max_id:
+        batch_last_id = min(last_id + BATCH_SIZE, max_id)
+        User \
+            .update(
+                follow_back_rank=User.UNKNOWN_RANK,
+                follows_viewer=False,
+                is_verified=False,
+                ) \
+            .where(
+                (User.id > last_id) &
+                (User.id <= batch_last_id) &
+                (User.follow_back_rank >> None),
+                ) \
+            .execute()
+        last_id = batch_last_id
+        LOGGER.info(
+            'Profile stats of users till ID %d of %d were filled in',
+            last_id,
+            max_id,
+            )
+
+
+def _get_foreign_key(db, table, column):
+    """
+    Returns:
+        (str, str): Name of the constraint and the referenced table. `None`
+        if there's no foreign key.
+
+    """
+    cursor = db.execute_sql(
+        'SELECT constraint_name, referenced_table_name '
+        'FROM information_schema.key_column_usage '
+        'WHERE table_schema = DATABASE() AND table_name = %s AND '
+        'column_name = %s AND referenced_table_name IS NOT NULL',
+        (table, column),
+        )
+    return cursor.fetchone()
@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+from .clock import Clock
+from .errors import ConfigurationError
+from .metrics import REGISTRY
+
+DEFAULT_LATENCY_TARGETS = {
+    'crawl': 60 * 60,
+    'follow': 30 * 60,
+    'like': 15 * 60,
+    'unfollow': 5 * 60,
+    }
+KINDS = tuple(sorted(DEFAULT_LATENCY_TARGETS))
+# Budgets spent by kinds of work.
+KIND_ACTIONS = {
+    'crawl': 'query',
+    'follow': 'follow',
+    'like': 'like',
+    'unfollow': 'unfollow',
+    }
+LOGGER = logging.getLogger('instabot.scheduler')
+MISSED_DEADLINES = REGISTRY.counter(
+    'instabot_scheduler_missed_deadlines_total',
+    'Work items started after their deadline by kind.',
+    )
+QUEUED = REGISTRY.gauge(
+    'instabot_scheduler_queued',
+    'Work items waiting for a worker by kind.',
+    )
+WAIT_DURATION = REGISTRY.histogram(
+    'instabot_scheduler_wait_seconds',
+    'Time work items spent in the queue by kind.',
+    buckets=(1, 5, 15, 60, 5 * 60, 15 * 60, 30 * 60, 60 * 60, 3 * 60 * 60),
+    )
+
+_Work = collections.namedtuple(
+    '_Work',
+    'deadline, number, kind, submitted, func, args, kwargs, future',
+    )
+
+
+class Scheduler:
+    """Runs work of all services by weights and deadlines of its kinds.
+
+    Services submit work items instead of calling the client directly. When
+    workers are short, queued kinds of work are started in proportion to
+    their weights, e.g. with weights 2 and 1 two follows are started per
+    crawl request. Deadline of the item is its submission time plus latency
+    target of its kind, and items which have missed their deadlines overtake
+    the rest by the earliest deadline. The pool of workers drains the queue.
+
+    Items wait for the budget of their action before they're queued, so
+    workers aren't held by requests which can't be issued yet.
+
+    Args:
+        configuration (Configuration)
+        clock (Clock, optional)
+        budget (Budget, optional): Budget shared with the clients.
+
+    Raises:
+        ConfigurationError: If unknown kinds of work, non-positive weights or
+            less than 1 worker were specified.
+
+    """
+    _instance = None
+
+    def __init__(self, configuration, clock=None, budget=None):
+        unknown_kinds = (
+            set(configuration.scheduler_latency_targets) |
+            set(configuration.scheduler_weights)
+            ) - set(KINDS)
+        if unknown_kinds:
+            raise ConfigurationError('Unknown kinds of work: {}'.format(
+                ', '.join(sorted(unknown_kinds)),
+                ))
+        if any(weight <= 0
+               for weight in configuration.scheduler_weights.values()):
+            raise ConfigurationError('Weights should be positive')
+        if configuration.scheduler_workers < 1:
+            raise ConfigurationError('At least 1 worker is needed')
+        self._budget = budget
+        self._clock = Clock() if clock is None else clock
+        self._latency_targets = {
+            kind: datetime.timedelta(seconds=target)
+            for kind, target in itertools.chain(
+                DEFAULT_LATENCY_TARGETS.items(),
+                configuration.scheduler_latency_targets.items(),
+                )
+            }
+        self._numbers = itertools.count()
+        # Kind -> heap of queued work items.
+        self._queues = {kind: [] for kind in KINDS}
+        self._ready = asyncio.Semaphore(0)
+        # Weighted fair sharing of workers between kinds: every started item
+        # advances the pass of its kind by 1 / weight and the kind with the
+        # least pass goes next.
+        self._passes = dict.fromkeys(KINDS, 0)
+        self._pass = 0
+        self._weights = dict.fromkeys(KINDS, 1)
+        self._weights.update(configuration.scheduler_weights)
+        self._workers_count = configuration.scheduler_workers
+        REGISTRY.add_collector(self._collect_stats)
+        type(self)._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    async def run(self):
+        await asyncio.gather(*(
+            self._work()
+            for _ in range(self._workers_count)
+            ))
+
+    async def submit(self, kind, func, *args, **kwargs):
+        """Queues coroutine function call and waits for its result.
+
+        Args:
+            kind (str): One of `KINDS`.
+            func: Coroutine function to call.
+
+        Returns:
+            Result of the call.
+
+        Raises:
+            Whatever the call raises.
+
+        """
+        deadline = self._clock.now() + self._latency_targets[kind]
+        if self._budget is not None:
+            await self._budget.reserve(KIND_ACTIONS[kind])
+        future = asyncio.get_event_loop().create_future()
+        queue = self._queues[kind]
+        if not queue:
+            # Kind which was idle doesn't get the share it has missed.
+            self._passes[kind] = max(self._passes[kind], self._pass)
+        heapq.heappush(queue, _Work(
+            deadline=deadline,
+            number=next(self._numbers),
+            kind=kind,
+            submitted=self._clock.now(),
+            func=func,
+            args=args,
+            kwargs=kwargs,
+            future=future,
+            ))
+        self._ready.release()
+        return await future
+
+    def _collect_stats(self):
+        for kind in KINDS:
+            QUEUED.set(len(self._queues[kind]), kind=kind)
+
+    def _pop(self):
+        """Takes the next work item from the queues."""
+        now = self._clock.now()
+        kinds = [kind for kind in KINDS if self._queues[kind]]
+        late_kinds = [
+            kind for kind in kinds
+            if self._queues[kind][0].deadline <= now
+            ]
+        if late_kinds:
+            kind = min(late_kinds, key=lambda kind: self._queues[kind][0])
+        else:
+            kind = min(
+                kinds,
+                key=lambda kind: (self._passes[kind], self._queues[kind][0]),
+                )
+        self._pass = self._passes[kind]
+        self._passes[kind] += 1 / self._weights[kind]
+        return heapq.heappop(self._queues[kind])
+
+    async def _work(self):
+        while True:
+            await self._ready.acquire()
+            work = self._pop()
+            if work.future.cancelled():
+                continue
+            now = self._clock.now()
+            WAIT_DURATION.observe(
+                (now - work.submitted).total_seconds(),
+                kind=work.kind,
+                )
+            if now > work.deadline:
+                LOGGER.debug(
+                    '%s has missed its deadline by %.0f sec',
+                    work.kind,
+                    (now - work.deadline).total_seconds(),
+                    )
+                MISSED_DEADLINES.increment(kind=work.kind)
+            try:
+                result = await work.func(*work.args, **work.kwargs)
+            except asyncio.CancelledError:
+                work.future.cancel()
+                raise
+            except Exception as e:
+                if not work.future.cancelled():
+                    work.future.set_exception(e)
+            else:
+                if not work.future.cancelled():
+                    work.future.set_result(result)
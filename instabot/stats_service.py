@@ -1,5 +1,5 @@
-import asyncio
 import logging
+from .clock import Clock
 
 LOGGER = logging.getLogger('instabot.stats_service')
 
@@ -11,9 +11,8 @@ class Counter:
     def clear(self):
         self._counter.clear()
 
-    def increment(self, key):
-        value = self._counter.get(key, 0)
-        self._counter[key] = value + 1
+    def increment(self, key, value=1):
+        self._counter[key] = self._counter.get(key, 0) + value
 
     def report(self, prefix):
         LOGGER.info('{} {!s}'.format(prefix, self._counter))
@@ -22,7 +21,8 @@ class Counter:
 class StatsService:
     _instance = None
 
-    def __init__(self):
+    def __init__(self, clock=None):
+        self._clock = Clock() if clock is None else clock
         self._hourly_counter = Counter()
         self._daily_counter = Counter()
         type(self)._instance = self
@@ -34,7 +34,7 @@ class StatsService:
     async def run(self):
         hour = 0
         while True:
-            await asyncio.sleep(60 * 60)
+            await self._clock.sleep(60 * 60)
             hour += 1
             if hour % 24 == 0:
                 self._daily_counter.report(
@@ -45,6 +45,6 @@ class StatsService:
                 self._hourly_counter.report('Hourly stats #{}'.format(hour))
             self._hourly_counter.clear()
 
-    def increment(self, key):
-        self._hourly_counter.increment(key)
-        self._daily_counter.increment(key)
+    def increment(self, key, value=1):
+        self._hourly_counter.increment(key, value)
+        self._daily_counter.increment(key, value)
@@ -1,14 +1,34 @@
 import datetime
+import math
 from peewee import *
 
 database_proxy = Proxy()
 
 
 class User(Model):
+    # Values of `state`.
+    # Wasn't followed yet.
+    CANDIDATE = 0
+    # Is followed now.
+    FOLLOWED = 1
+    # Was followed and unfollowed or can't be followed at all.
+    FINISHED = 2
+
+    # Values of `follow_back_rank`, less is better.
+    BEST_RANK = 0
+    # Profile stats weren't fetched.
+    UNKNOWN_RANK = 50
+    WORST_RANK = 100
+
     created = DateTimeField(default=datetime.datetime.utcnow)
-    following_depth = IntegerField()
-    instagram_id = CharField(max_length=20, unique=True)
-    is_followed = BooleanField(default=False)
+    follow_back_rank = SmallIntegerField(default=UNKNOWN_RANK)
+    followers_count = IntegerField(null=True)
+    following_depth = SmallIntegerField()
+    follows_count = IntegerField(null=True)
+    follows_viewer = BooleanField(default=False)
+    instagram_id = BigIntegerField(unique=True)
+    is_verified = BooleanField(default=False)
+    state = SmallIntegerField(default=CANDIDATE)
     username = CharField(max_length=30)
     was_followed_at = DateTimeField(null=True)
     were_followers_fetched = BooleanField(default=False)
@@ -16,9 +36,33 @@ class User(Model):
     class Meta:
         database = database_proxy
         indexes = (
-            (('is_followed', 'was_followed_at'), False),
+            # Covers counting users to follow by depth.
+            (('state', 'following_depth', 'created'), False),
+            # Covers keyset pagination of users to follow by rank.
+            (('state', 'follow_back_rank', 'created'), False),
+            (('state', 'was_followed_at'), False),
             (('were_followers_fetched', 'following_depth', 'created'), False),
             )
 
+    @classmethod
+    def get_follow_back_rank(cls, followers_count, follows_count,
+                             is_verified, follows_viewer):
+        """Estimates how likely the user is to follow us back.
+
+        Users who follow many accounts compared to their own audience tend
+        to follow back, celebrities and verified accounts don't. Users who
+        follow us already give nothing when followed, so they go last.
+
+        Returns:
+            int: Rank from `BEST_RANK` to `WORST_RANK`, less is better.
+
+        """
+        if is_verified or follows_viewer:
+            return cls.WORST_RANK
+        # Every doubling of follows to followers ratio is worth 10 points.
+        ratio = (follows_count + 1) / (followers_count + 1)
+        rank = cls.UNKNOWN_RANK - round(10 * math.log2(ratio))
+        return max(cls.BEST_RANK, min(cls.WORST_RANK - 1, rank))
+
     def get_url(self):
         return 'https://www.instagram.com/{0}/'.format(self.username)
@@ -1,18 +1,33 @@
-import asyncio
 import logging
 import peewee
+from .candidate_counters import CandidateCounters
+from .clock import Clock
+from .db import run_in_db
 from .errors import APIError, APIJSONError, APILimitError, \
     APINotAllowedError, ConfigurationError
+from .followers_cursor import FollowersCursor
+from .known_users import KnownUsers
+from .scheduler import Scheduler
 from .stats_service import StatsService
 from .user import User
 from aiohttp.errors import ClientResponseError
 
+CRAWL_BATCH_SIZE = 20
+INGEST_BATCH_SIZE = 100
 LOGGER = logging.getLogger('instabot.user_service')
+PAGES_PER_VISIT = 3
+# Share of new users among fetched followers which makes us visit the user
+# again instead of considering his followers fetched.
+REVISIT_YIELD_MIN = 0.3
 
 
 class UserService:
-    def __init__(self, client, configuration):
+    def __init__(self, client, configuration, clock=None):
+        self._candidate_counters = CandidateCounters.get_instance()
         self._client = client
+        self._clock = Clock() if clock is None else clock
+        self._known_users = KnownUsers.get_instance()
+        self._scheduler = Scheduler.get_instance()
         self._stats_service = StatsService.get_instance()
         self._users_to_follow_cache_size = configuration \
             .users_to_follow_cache_size
@@ -24,67 +39,235 @@ class UserService:
             try:
                 await self._ensure_enough_users()
             except APILimitError as e:
-                LOGGER.debug('Instagram limits were reached. {}'.format(e))
+                LOGGER.debug('Instagram limits were reached. %s', e)
             except (APIError, APIJSONError, APINotAllowedError) as e:
                 LOGGER.debug(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
             except (IOError, OSError, ClientResponseError) as e:
                 LOGGER.warning(e)
-                await asyncio.sleep(5)
+                await self._clock.sleep(5)
+            except peewee.PeeweeException as e:
+                LOGGER.warning('Can\'t fetch users to follow: %s', e)
+                await self._clock.sleep(60)
             else:
-                await asyncio.sleep(60 * 5)
+                await self._clock.sleep(60 * 5)
 
     async def _ensure_enough_users(self):
-        users_to_follow_count = User.select() \
-            .where(User.was_followed_at == None) \
-            .count()
-        LOGGER.debug('{} users to follow found'.format(users_to_follow_count))
+        users_to_follow_count = len(self._candidate_counters)
+        LOGGER.debug('%d users to follow found', users_to_follow_count)
         if users_to_follow_count < self._users_to_follow_cache_size:
             last_users_to_follow_count = users_to_follow_count
-            for user in User.select() \
-                .where(User.were_followers_fetched == False) \
-                .order_by(
-                    User.following_depth,
-                    User.created,
-                    ):
-                following_depth = user.following_depth + 1
-                try:
-                    followers_json = \
-                        await self._client.get_some_followers(user)
-                except APINotAllowedError as e:
-                    LOGGER.debug(
-                        'Can\'t fetch followers of {}. {}'.format(
-                            user.username,
-                            e,
-                            ),
-                        )
-                    user.were_followers_fetched = True
-                    user.save()
-                    continue
-                user.were_followers_fetched = True
-                user.save()
-                LOGGER.debug(
-                    '{} followers of {} were fetched'.format(
-                        len(followers_json),
-                        user.username,
-                        ),
-                    )
-                for follower_json in followers_json:
-                    try:
-                        User.create(
-                            instagram_id=follower_json['id'],
-                            following_depth=following_depth,
-                            username=follower_json['username'],
-                            )
-                    except peewee.IntegrityError:
-                        pass
-                    else:
-                        users_to_follow_count += 1
-                        self._stats_service \
-                            .increment('users_to_follow_fetched')
-                if users_to_follow_count >= self._users_to_follow_cache_size:
+            last_user = None
+            while users_to_follow_count < self._users_to_follow_cache_size:
+                users = await run_in_db(self._get_users_to_crawl, last_user)
+                if not users:
                     break
+                for user in users:
+                    users_to_follow_count += \
+                        await self._fetch_followers(user)
+                    if users_to_follow_count >= \
+                            self._users_to_follow_cache_size:
+                        break
+                last_user = users[-1]
             LOGGER.debug(
                 '%d users were saved in DB',
                 users_to_follow_count - last_users_to_follow_count,
                 )
+
+    async def _fetch_followers(self, user):
+        """Fetches next pages of followers of given user and saves them page
+        by page.
+
+        The crawl continues from the cursor saved during the last visit. The
+        user is considered to be crawled if all of his followers were
+        fetched or if the last visit yielded too few new users.
+
+        Returns:
+            int: Number of new users.
+
+        Raises:
+            APIError
+            APIJSONError
+            APILimitError
+
+        """
+        cursor = await run_in_db(self._get_followers_cursor, user)
+        pages_to_fetch = PAGES_PER_VISIT
+        following_depth = user.following_depth + 1
+        fetched_count = 0
+        new_count = 0
+        has_next_page = True
+        LOGGER.debug('Fetching followers of %s', user.username)
+        pages = self._client.iter_followers(user, cursor.end_cursor)
+        try:
+            while has_next_page:
+                # Every page is a separate work item for the scheduler.
+                followers_json, end_cursor, has_next_page = \
+                    await self._scheduler.submit('crawl', pages.__anext__)
+                page_new_count, _ = await run_in_db(
+                    self._save_followers,
+                    followers_json,
+                    following_depth,
+                    )
+                self._candidate_counters.add(following_depth, page_new_count)
+                fetched_count += len(followers_json)
+                new_count += page_new_count
+                self._stats_service.increment(
+                    'users_to_follow_fetched',
+                    page_new_count,
+                    )
+                cursor.end_cursor = end_cursor if has_next_page else None
+                cursor.fetched_count += len(followers_json)
+                cursor.new_count += page_new_count
+                cursor.updated = self._clock.now()
+                await run_in_db(cursor.save)
+                pages_to_fetch -= 1
+                if pages_to_fetch == 0:
+                    break
+        except APINotAllowedError as e:
+            LOGGER.debug(
+                'Can\'t fetch followers of %s. %s',
+                user.username,
+                e,
+                )
+            has_next_page = False
+        finally:
+            await pages.aclose()
+        if not has_next_page or \
+                new_count <= fetched_count * REVISIT_YIELD_MIN:
+            user.were_followers_fetched = True
+            # The row may have been changed by other services during the
+            # crawl, so only the flag is saved.
+            await run_in_db(
+                User
+                .update(were_followers_fetched=True)
+                .where(User.id == user.id)
+                .execute,
+                )
+        LOGGER.debug(
+            '%d followers of %s were fetched, %d of them are new',
+            fetched_count,
+            user.username,
+            new_count,
+            )
+        return new_count
+
+    def _get_followers_cursor(self, user):
+        try:
+            return FollowersCursor.get(FollowersCursor.user == user)
+        except FollowersCursor.DoesNotExist:
+            return FollowersCursor.create(user=user)
+
+    def _get_users_to_crawl(self, last_user=None):
+        """Returns next batch of users whose followers should be fetched.
+
+        Args:
+            last_user (User, optional): The last user of the previous batch.
+
+        """
+        query = User.select().where(User.were_followers_fetched == False)
+        if last_user is not None:
+            query = query.where(
+                peewee.Tuple(User.following_depth, User.created, User.id) >
+                peewee.Tuple(
+                    last_user.following_depth,
+                    last_user.created,
+                    last_user.id,
+                    ),
+                )
+        return list(
+            query
+            .order_by(User.following_depth, User.created, User.id)
+            .limit(CRAWL_BATCH_SIZE)
+            )
+
+    def _save_followers(self, followers_json, following_depth):
+        """Saves fetched followers in batches.
+
+        Followers are deduplicated by Instagram ID, users which are already
+        known are skipped without querying DB and the rest are written with
+        a single multi-row INSERT per batch. Profile stats are saved along
+        with the rank they give. Users who are followed or requested to be
+        followed already aren't saved, following them would waste an
+        action.
+
+        Args:
+            followers_json (list): Follower dicts as returned by
+                `Client.iter_followers`.
+            following_depth (int): Depth to assign to new users.
+
+        Returns:
+            (int, int): Numbers of new and already known users.
+
+        """
+        followers = {}
+        for follower_json in followers_json:
+            if follower_json.get('followed_by_viewer') or \
+                    follower_json.get('requested_by_viewer'):
+                continue
+            followers.setdefault(follower_json['id'], follower_json)
+        rows = [
+            _get_user_row(instagram_id, follower_json, following_depth)
+            for instagram_id, follower_json in followers.items()
+            if instagram_id not in self._known_users
+            ]
+        new_count = 0
+        for i in range(0, len(rows), INGEST_BATCH_SIZE):
+            batch = rows[i:i + INGEST_BATCH_SIZE]
+            try:
+                with User._meta.database.atomic():
+                    User.insert_many(batch).execute()
+            except peewee.IntegrityError:
+                # Some of these users were inserted by somebody else.
+                new_count += self._save_followers_one_by_one(batch)
+            else:
+                new_count += len(batch)
+            for row in batch:
+                self._known_users.add(row['instagram_id'])
+        return new_count, len(followers) - new_count
+
+    def _save_followers_one_by_one(self, rows):
+        new_count = 0
+        for row in rows:
+            try:
+                User.create(**row)
+            except peewee.IntegrityError:
+                pass
+            else:
+                new_count += 1
+        return new_count
+
+
+def _get_user_row(instagram_id, follower_json, following_depth):
+    """
+    Returns:
+        dict: Fields of `User` to insert for the follower. All rows have the
+        same keys, so they can be inserted with a single query.
+
+    """
+    try:
+        followers_count = follower_json['followed_by']['count']
+        follows_count = follower_json['follows']['count']
+        is_verified = follower_json['is_verified']
+        follows_viewer = follower_json['follows_viewer']
+    except (KeyError, TypeError):
+        followers_count = follows_count = None
+        is_verified = follows_viewer = False
+        follow_back_rank = User.UNKNOWN_RANK
+    else:
+        follow_back_rank = User.get_follow_back_rank(
+            followers_count,
+            follows_count,
+            is_verified,
+            follows_viewer,
+            )
+    return {
+        'follow_back_rank': follow_back_rank,
+        'followers_count': followers_count,
+        'following_depth': following_depth,
+        'follows_count': follows_count,
+        'follows_viewer': follows_viewer,
+        'instagram_id': instagram_id,
+        'is_verified': is_verified,
+        'username': follower_json['username'],
+        }